@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import functools
 import hashlib
+import io
 import json
 import logging
 import os
@@ -10,6 +12,7 @@ import re
 import shutil
 import sys
 import tempfile
+import threading
 import time
 import zipfile
 
@@ -30,6 +33,85 @@ class IndentDumper(yaml.Dumper):
         return super().increase_indent(flow, False)
 
 
+MANIFEST_LISTS = ('folder', 'item', 'file', 'annotation')
+
+
+def add_manifest_record(manifest, record):
+    """
+    Add a record to the appropriate list of a manifest based on its model.
+
+    :param manifest: the manifest to modify.
+    :param record: a folder, collection, item, file, or annotation record.
+    """
+    model = record.get('model', 'annotation')
+    manifest.setdefault('folder' if model == 'collection' else model, []).append(record)
+
+
+def manifest_records(manifest):
+    """
+    Iterate through the records of a manifest in the order they need to be
+    created.
+
+    :param manifest: the manifest.
+    :yields: folder, item, file, and annotation records.
+    """
+    for key in MANIFEST_LISTS:
+        for record in manifest.get(key, []):
+            if key == 'annotation' and 'model' not in record:
+                record = dict(model='annotation', **record)
+            yield record
+
+
+def read_manifest(zf):
+    """
+    Read the manifest from a demo set.  Demo sets can either have a
+    manifest.yaml file or a manifest.jsonl file.  The latter has the general
+    manifest information on its first line and then one folder, item, file, or
+    annotation record per line, which is much faster to read for large demo
+    sets.  Either way, the whole manifest is read into memory, since
+    installing a demo set needs every record to order items, files, and
+    annotations.
+
+    :param zf: an open zipfile.
+    :returns: the manifest.
+    """
+    if 'manifest.jsonl' not in zf.NameToInfo:
+        return yaml.load(zf.read('manifest.yaml'),
+                         Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+    with zf.open('manifest.jsonl') as fptr:
+        lines = io.TextIOWrapper(fptr, encoding='utf8')
+        manifest = json.loads(lines.readline())
+        for key in MANIFEST_LISTS:
+            manifest.setdefault(key, [])
+        for line in lines:
+            if line.strip():
+                add_manifest_record(manifest, json.loads(line))
+    return manifest
+
+
+def write_manifest(zf, manifest, format='yaml'):
+    """
+    Write the manifest to a demo set.  The jsonl format is only a faster
+    encoding; the manifest is still built completely in memory before it is
+    written, since the records can be renamed when the demo set is finished.
+
+    :param zf: an open zipfile.
+    :param manifest: the manifest.
+    :param format: either 'yaml' to write manifest.yaml or 'jsonl' to write
+        manifest.jsonl.  See read_manifest.
+    """
+    if format != 'jsonl':
+        zf.writestr('manifest.yaml', yaml.dump(
+            manifest, Dumper=IndentDumper, default_flow_style=False, sort_keys=False))
+        return
+    with zf.open('manifest.jsonl', 'w', force_zip64=True) as fptr:
+        fptr.write(json.dumps(
+            {k: v for k, v in manifest.items() if k not in MANIFEST_LISTS},
+            separators=(',', ':')).encode() + b'\n')
+        for record in manifest_records(manifest):
+            fptr.write(json.dumps(record, separators=(',', ':')).encode() + b'\n')
+
+
 def get_girder_client(opts):
     """
     Log in to Girder and return a reference to the client.
@@ -48,6 +130,69 @@ def get_girder_client(opts):
     return gc
 
 
+class DemoSetClient:
+    """
+    A girder client with the caches used while adding or creating one demo
+    set.  Attributes that aren't defined here are those of the wrapped client,
+    so this is used in place of it.
+    """
+
+    def __init__(self, gc):
+        """
+        :param gc: authenticated girder client.
+        """
+        self.client = gc
+        # Resource documents by Girder resource path without leading or
+        # trailing slashes
+        self.paths = {}
+        # Girder resource paths of folders by folder id
+        self.folderPaths = {}
+        # Uploaded file documents and the locks used to upload them, both by
+        # the sha512 hash of the file
+        self.blobs = {}
+        self.blobLocks = {}
+        self.blobLock = threading.Lock()
+        self.userIdResolved = False
+        self.userId = None
+
+    def __getattr__(self, key):
+        return getattr(self.client, key)
+
+
+def lookup_path(gc, path):
+    """
+    Find the resource associated with a Girder resource path.  Resolved paths
+    are remembered so that each distinct path is only looked up once.
+
+    :param gc: a DemoSetClient.
+    :param path: the path to locate.
+    :returns: the resource document or None if it does not exist.
+    """
+    key = path.strip('/')
+    if key not in gc.paths:
+        try:
+            gc.paths[key] = gc.get('resource/lookup', parameters={'path': path})
+        except girder_client.HttpError:
+            return None
+    return gc.paths[key]
+
+
+def remember_path(gc, path, doc):
+    """
+    Record the resource document for a Girder resource path, such as one that
+    was just created.  If the document is None, forget the path so that it
+    will be looked up again.
+
+    :param gc: a DemoSetClient.
+    :param path: the resource path.
+    :param doc: the resource document or None.
+    """
+    if doc is None:
+        gc.paths.pop(path.strip('/'), None)
+    else:
+        gc.paths[path.strip('/')] = doc
+
+
 def find_or_create_path(gc, path, dryrun):
     """
     Find the resource associated with a Girder resource path.  If it doesn't
@@ -57,36 +202,165 @@ def find_or_create_path(gc, path, dryrun):
     :param path: the path to locate or create.
     :param dryrun: if True, don't actually create anything.
     """
-    try:
-        doc = gc.get('resource/lookup', parameters={'path': path})
+    doc = lookup_path(gc, path)
+    if doc is not None:
         return doc
-    except girder_client.HttpError:
-        pass
     parts = path.strip(os.path.sep).split(os.path.sep)
     last = None
     for plen in range(2, len(parts) + 1):
         subpath = os.path.sep.join(parts[:plen])
-        try:
-            doc = gc.get('resource/lookup', parameters={'path': subpath})
+        doc = lookup_path(gc, subpath)
+        if doc is not None:
             last = doc
             continue
-        except girder_client.HttpError:
-            pass
         if plen == 2 and parts[0] == 'collection':
             # Public
             logger.info(f'Creating collection {parts[plen - 1]}')
             if not dryrun:
                 last = gc.createCollection(parts[plen - 1], '', True)
                 last['_modelType'] = 'collection'
+                remember_path(gc, subpath, last)
         else:
             logger.info(f'Creating folder {subpath}')
             if not dryrun:
                 last = gc.createFolder(
                     last['_id'], parts[plen - 1], '', last.get('_modelType', 'folder'), True, True)
+                last['_modelType'] = 'folder'
+                remember_path(gc, subpath, last)
         doc = last
     return doc
 
 
+class RemoteFile(io.RawIOBase):
+    """
+    A read-only, seekable file-like object for a URL that fetches byte ranges
+    on demand.  Fetched data is cached in a local file so each byte is only
+    downloaded once.  This allows a zipfile to read its central directory and
+    individual members without downloading the whole archive.
+    """
+
+    blockSize = 1024 ** 2
+    readAheadBlocks = 16
+
+    def __init__(self, url, cachepath):
+        """
+        :param url: the url of the file.  The server must support range
+            requests; if it does not, a ValueError is raised.
+        :param cachepath: a local path used to store fetched data.
+        """
+        super().__init__()
+        self.url = url
+        self.session = requests.Session()
+        r = self.session.head(url, allow_redirects=True)
+        r.raise_for_status()
+        if (r.headers.get('Accept-Ranges', '').lower() != 'bytes' or
+                'Content-Length' not in r.headers):
+            self.session.close()
+            msg = f'{url} does not support range requests'
+            raise ValueError(msg)
+        self.url = r.url
+        self.size = int(r.headers['Content-Length'])
+        self.pos = 0
+        self.blocks = set()
+        self.cache = open(cachepath, 'w+b')
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            msg = 'Negative seek position'
+            raise ValueError(msg)
+        self.pos = offset
+        return self.pos
+
+    def _fetch(self, start, end):
+        """
+        Ensure that a range of bytes is in the local cache.
+
+        :param start: the first byte needed.
+        :param end: one past the last byte needed.
+        """
+        block = start // self.blockSize
+        lastblock = (end - 1) // self.blockSize
+        maxblock = (self.size - 1) // self.blockSize
+        while block <= lastblock:
+            if block in self.blocks:
+                block += 1
+                continue
+            runend = block
+            while (runend + 1 <= maxblock and runend + 1 not in self.blocks and (
+                    runend + 1 <= lastblock or runend + 1 < block + self.readAheadBlocks)):
+                runend += 1
+            first = block * self.blockSize
+            last = min(self.size, (runend + 1) * self.blockSize) - 1
+            with self.session.get(self.url, stream=True, headers={
+                    'Range': f'bytes={first}-{last}'}) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    msg = f'{self.url} did not honor a range request'
+                    raise ValueError(msg)
+                self.cache.seek(first)
+                for chunk in r.iter_content(chunk_size=65536):
+                    self.cache.write(chunk)
+            self.blocks.update(range(block, runend + 1))
+            block = runend + 1
+
+    def readinto(self, b):
+        length = min(len(b), self.size - self.pos)
+        if length <= 0:
+            return 0
+        self._fetch(self.pos, self.pos + length)
+        self.cache.seek(self.pos)
+        length = self.cache.readinto(memoryview(b)[:length])
+        self.pos += length
+        return length
+
+    def close(self):
+        if not self.closed:
+            self.cache.close()
+            self.session.close()
+        super().close()
+
+
+def open_demo_set(demo, tempdir):
+    """
+    Get a file path or file-like object for a demo set zip file.  URLs are
+    read with range requests if the server supports them, and are otherwise
+    downloaded in full.
+
+    :param demo: a file path or URL of the demo set zip file.
+    :param tempdir: a temporary directory for downloaded data.
+    :returns: a path or file-like object that can be opened as a zipfile.
+    """
+    if os.path.exists(demo):
+        return demo
+    try:
+        remote = RemoteFile(demo, os.path.join(tempdir, 'remote.zip'))
+        logger.info(f'Reading {demo} remotely')
+        return remote
+    except (ValueError, requests.RequestException):
+        pass
+    dest = os.path.join(tempdir, 'temp.zip')
+    logger.info(f'Downloading {demo}')
+    with requests.get(demo, stream=True) as r:
+        r.raise_for_status()
+        with open(dest, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=65536):
+                f.write(chunk)
+    return dest
+
+
 def zip_to_file(zf, name, path):
     """
     Extract a single file from a zipfile and store it as a local file.
@@ -123,6 +397,8 @@ def put_folders(gc, manifest, path, dryrun):
                 parent['_id'], folder['name'],
                 folder.get('description') or '',
                 parent.get('_modelType', 'folder'), True, True)
+            folder['doc']['_modelType'] = 'folder'
+            remember_path(gc, os.path.join(parentpath, folder['name']), folder['doc'])
             if len(folder.get('metadata', {})):
                 gc.post(
                     f'folder/{folder["doc"]["_id"]}/metadata',
@@ -130,32 +406,40 @@ def put_folders(gc, manifest, path, dryrun):
                     headers={'X-HTTP-Method': 'PUT', 'Content-Type': 'application/json'})
 
 
-def put_items(gc, manifest, path, dryrun):
+def put_item(gc, manifest, iidx, item, path, dryrun):
     """
-    Create items for a demo set.  This is idempotent.
+    Create one item for a demo set.  This is idempotent.
 
     :param gc: authenticated girder client.
     :param manifest: the manifest listing the items.
+    :param iidx: the zero-based index of the item in the manifest.
+    :param item: the manifest item record.
     :param path: the base girder resource path for placement.
     :param dryrun: if True, don't actually create anything.
     """
-    for iidx, item in enumerate(manifest['item']):
-        parent = find_or_create_path(
-            gc, parentpath := os.path.join(path, item['parent']), dryrun)
-        logger.info(f'Creating item {iidx + 1}/{len(manifest["item"])} '
-                    f'{parentpath}/{item["name"]}')
-        if not dryrun:
-            item['doc'] = gc.createItem(
-                parent['_id'], item['name'], item['description'], True)
-            if len(item.get('metadata', {})):
-                gc.post(
-                    f'item/{item["doc"]["_id"]}/metadata',
-                    data=json.dumps(item['metadata'], separators=(',', ':')),
-                    headers={'X-HTTP-Method': 'PUT', 'Content-Type': 'application/json'})
+    parent = find_or_create_path(
+        gc, parentpath := os.path.join(path, item['parent']), dryrun)
+    logger.info(f'Creating item {iidx + 1}/{len(manifest["item"])} '
+                f'{parentpath}/{item["name"]}')
+    if not dryrun:
+        item['doc'] = gc.createItem(
+            parent['_id'], item['name'], item['description'], True)
+        item['doc']['_modelType'] = 'item'
+        remember_path(gc, os.path.join(parentpath, item['name']), item['doc'])
+        if len(item.get('metadata', {})):
+            gc.post(
+                f'item/{item["doc"]["_id"]}/metadata',
+                data=json.dumps(item['metadata'], separators=(',', ':')),
+                headers={'X-HTTP-Method': 'PUT', 'Content-Type': 'application/json'})
 
 
-@functools.lru_cache()
-def get_sha512(path):
+def sha512_file(path):
+    """
+    Compute the sha512 hash of a file.
+
+    :param path: the path of the file.
+    :returns: the hex digest.
+    """
     sha = hashlib.sha512()
     with open(path, 'rb') as f:
         while True:
@@ -167,12 +451,95 @@ def get_sha512(path):
     return sha
 
 
-def put_files(gc, manifest, path, dryrun, tempdir, zf, imported=None):
+@functools.lru_cache()
+def get_sha512(path):
+    return sha512_file(path)
+
+
+_importLock = threading.Lock()
+
+
+def blob_lock(gc, sha):
+    """
+    Get a lock used to make sure each distinct file is uploaded once.
+
+    :param gc: a DemoSetClient.
+    :param sha: the sha512 hash of the file.
+    :returns: a lock.
     """
-    Upload files for a demo set.  This is idempotent.
+    with gc.blobLock:
+        return gc.blobLocks.setdefault(sha, threading.Lock())
+
+
+def put_file_data(gc, file, item, temppath, imported=None):
+    """
+    Upload a file to an item unless it is already present.
+
+    :param gc: authenticated girder client.
+    :param file: the manifest file record.  The file document is added to it.
+    :param item: the girder item document.
+    :param temppath: the local path of the file's data.
+    :param imported: if not None, a colon delimited specification to import
+        rather than upload files.  See put_demo_set.
+    """
+    fileId, current = gc.isFileCurrent(item['_id'], file['name'], temppath)
+    if fileId is not None and current:
+        file['doc'] = gc.getFile(fileId)
+        return
+    file['doc'] = gc.uploadFileToItem(
+        item['_id'], temppath, mimeType=file['mimeType'],
+        filename=file['name'])
+    if imported:
+        localpath, assetstoreId, remotepath = imported.split(':')
+        os.makedirs(localpath, exist_ok=True)
+        destname = file['name']
+        destbase, destext = os.path.splitext(destname)
+        destpath = os.path.join(localpath, destname)
+        tempsha = file.get('sha512') or sha512_file(temppath)
+        num = 0
+        with _importLock:
+            while os.path.exists(destpath):
+                if get_sha512(destpath) == tempsha:
+                    break
+                num += 1
+                destname = f'{destbase} ({num}){destext}'
+                destpath = os.path.join(localpath, destname)
+            shutil.copy(temppath, destpath)
+        gc.post(f'file/{file["doc"]["_id"]}/import/adjust_path', parameters={
+            'path': os.path.join(remotepath, destname)})
+
+
+def put_file_copy(gc, file, item, source):
+    """
+    Add a file to an item as a server-side copy of an already uploaded file
+    with the same contents unless it is already present.
+
+    :param gc: authenticated girder client.
+    :param file: the manifest file record.  The file document is added to it.
+    :param item: the girder item document.
+    :param source: the girder file document of the uploaded file.
+    """
+    for existing in gc.listFile(item['_id']):
+        if (existing['name'] == file['name'] and existing['size'] == source['size'] and
+                existing.get('sha512', file['sha512']) == file['sha512']):
+            file['doc'] = existing
+            return
+    doc = gc.post(f'file/{source["_id"]}/copy', parameters={'itemId': item['_id']})
+    if doc['name'] != file['name']:
+        doc = gc.put(f'file/{doc["_id"]}', parameters={'name': file['name']})
+    file['doc'] = doc
+
+
+def put_file(gc, manifest, fidx, file, path, dryrun, tempdir, zf, imported=None):
+    """
+    Upload one file for a demo set.  This is idempotent.  Files with the same
+    sha512 hash are only uploaded once; other references are server-side
+    copies of the first upload.
 
     :param gc: authenticated girder client.
     :param manifest: the manifest listing the files.
+    :param fidx: the zero-based index of the file in the manifest.
+    :param file: the manifest file record.
     :param path: the base girder resource path for placement.
     :param dryrun: if True, don't actually create anything.
     :param tempdir: a temporary directory for extracting files from the
@@ -182,74 +549,121 @@ def put_files(gc, manifest, path, dryrun, tempdir, zf, imported=None):
         rather than upload files of the form (local path):(assetstore id):
         (girder path).
     """
-    if imported and not dryrun:
-        localpath, assetstoreId, remotepath = imported.split(':')
-    else:
-        imported = None
-    for fidx, file in enumerate(manifest['file']):
-        parentpath = os.path.join(path, file['parent'])
-        logger.info(f'Creating file {fidx + 1}/{len(manifest["file"])} '
-                    f'{parentpath}/{file["name"]}')
-        if not dryrun:
-            item = gc.get('resource/lookup', parameters={'path': parentpath})
-            temppath = os.path.join(tempdir, 'datafile')
+    parentpath = os.path.join(path, file['parent'])
+    logger.info(f'Creating file {fidx + 1}/{len(manifest["file"])} '
+                f'{parentpath}/{file["name"]}')
+    if dryrun:
+        return
+    item = lookup_path(gc, parentpath)
+    sha = file.get('sha512')
+    temppath = os.path.join(tempdir, f'datafile{fidx}')
+    try:
+        if sha:
+            with blob_lock(gc, sha):
+                if sha in gc.blobs:
+                    put_file_copy(gc, file, item, gc.blobs[sha])
+                    return
+                zip_to_file(zf, file['localpath'], temppath)
+                put_file_data(gc, file, item, temppath, imported)
+                gc.blobs[sha] = file['doc']
+        else:
             zip_to_file(zf, file['localpath'], temppath)
-            fileId, current = gc.isFileCurrent(item['_id'], file['name'], temppath)
-            if fileId is not None and current:
-                file['doc'] = gc.getFile(fileId)
-            else:
-                file['doc'] = gc.uploadFileToItem(
-                    item['_id'], temppath, mimeType=file['mimeType'],
-                    filename=file['name'])
-                if imported:
-                    os.makedirs(localpath, exist_ok=True)
-                    destname = file['name']
-                    destbase, destext = os.path.splitext(destname)
-                    destpath = os.path.join(localpath, destname)
-                    tempsha = get_sha512(temppath)
-                    num = 0
-                    while os.path.exists(destpath):
-                        if get_sha512(destpath) == tempsha:
-                            break
-                        num += 1
-                        destname = f'{destbase} ({num}){destext}'
-                        destpath = os.path.join(localpath, destname)
-                    shutil.copy(temppath, destpath)
-                    gc.post(f'file/{file["doc"]["_id"]}/import/adjust_path', parameters={
-                        'path': os.path.join(remotepath, destname)})
+            put_file_data(gc, file, item, temppath, imported)
+    finally:
+        # The extracted data is removed even if the upload fails
+        if os.path.exists(temppath):
             os.unlink(temppath)
 
 
-def put_mark_large_images(gc, manifest):
+def put_mark_large_image(gc, manifest, iidx, item, path, files=None):
     """
-    Mark images in a demo set as large images as appropriate.
+    Mark one item in a demo set as a large image if appropriate.
 
     :param gc: authenticated girder client.
     :param manifest: the manifest listing the items.
+    :param iidx: the zero-based index of the item in the manifest.
+    :param item: the manifest item record.
+    :param path: the base girder resource path for placement.
+    :param files: the manifest file records to check for the large image
+        file.  If None, all files in the manifest are checked.
     """
-    for iidx, item in enumerate(manifest['item']):
-        if 'largeImage' in item:
-            fileId = None
-            for file in manifest['file']:
-                if item['largeImage'] == file['originalId']:
-                    fileId = file['doc']['_id']
-                    break
-            if fileId:
-                item['doc'] = gc.getItem(item['doc']['_id'])
-                if item['doc'].get('largeImage', {}).get('fileId') == fileId:
-                    continue
-                logger.info(f'Marking large image {iidx + 1}/{len(manifest["item"])} '
-                            f'{item["name"]}')
-                try:
-                    gc.delete(f'item/{item["doc"]["_id"]}/tiles')
-                except Exception:
-                    pass
-                gc.post(f'item/{item["doc"]["_id"]}/tiles', parameters={'fileId': fileId})
+    if 'largeImage' not in item:
+        return
+    fileId = None
+    for file in (files if files is not None else manifest['file']):
+        if item['largeImage'] == file['originalId']:
+            fileId = file['doc']['_id']
+            break
+    if fileId:
+        item['doc'] = gc.getItem(item['doc']['_id'])
+        if item['doc'].get('largeImage', {}).get('fileId') == fileId:
+            return
+        logger.info(f'Marking large image {iidx + 1}/{len(manifest["item"])} '
+                    f'{item["name"]}')
+        try:
+            gc.delete(f'item/{item["doc"]["_id"]}/tiles')
+        except Exception:
+            pass
+        gc.post(f'item/{item["doc"]["_id"]}/tiles', parameters={'fileId': fileId})
+        # The item document has changed, so look it up again if needed
+        remember_path(gc, os.path.join(path, item['parent'], item['name']), None)
+
+
+def get_user_id(gc):
+    """
+    Get the id of the user the girder client is acting as.  This is resolved
+    once per demo set.
+
+    :param gc: a DemoSetClient.
+    :returns: the user id or None.
+    """
+    if not gc.userIdResolved:
+        userId = None
+        user = gc.get('user/me')
+        if user:
+            userId = user['_id']
+        else:
+            token = gc.get('token/current')
+            if token:
+                userId = token['userId']
+        gc.userId = userId
+        gc.userIdResolved = True
+    return gc.userId
+
+
+def annotation_counts(manifest):
+    """
+    For each annotation in a manifest, count how many annotations up to and
+    including it have the same parent and name.
+
+    :param manifest: the manifest listing the annotations.
+    :returns: a list of counts parallel to the manifest's annotations.
+    """
+    seen = {}
+    counts = []
+    for annot in manifest['annotation']:
+        key = (annot['parent'], annot['name'])
+        seen[key] = seen.get(key, 0) + 1
+        counts.append(seen[key])
+    return counts
+
+
+def uploaded_item_ids(manifest):
+    """
+    Map the original ids of items in a manifest to the ids of the uploaded
+    items.
+
+    :param manifest: the manifest listing the items.
+    :returns: a dictionary of original ids to uploaded ids.
+    """
+    return {item['originalId']: item['doc']['_id']
+            for item in manifest['item'] if 'doc' in item}
 
 
-def put_annotations(gc, manifest, path, dryrun, tempdir, zf):  # noqa
+def put_annotation(gc, manifest, aidx, annot, path, dryrun, tempdir, zf,
+                   count=None, itemIds=None):
     """
-    Upload annotations for a demo set.  If the annotation is smaller than a
+    Upload one annotation for a demo set.  If the annotation is smaller than a
     certain size, it is posted directly to the item.  Larger annotations are
     uploaded as files with references to their parent and take some time to be
     ingested into the system.  This attempts to be idempotent based on
@@ -258,66 +672,215 @@ def put_annotations(gc, manifest, path, dryrun, tempdir, zf):  # noqa
 
     :param gc: authenticated girder client.
     :param manifest: the manifest listing the annotations.
+    :param aidx: the zero-based index of the annotation in the manifest.
+    :param annot: the manifest annotation record.
     :param path: the base girder resource path for placement.
     :param dryrun: if True, don't actually create anything.
     :param tempdir: a temporary directory for extracting annotations from the
         zipfile.
     :param zf: an open zipfile.
+    :param count: the number of annotations with the same parent and name up
+        to and including this one.  If None, this is computed.
+    :param itemIds: a dictionary of original item ids to uploaded item ids as
+        returned by uploaded_item_ids.  If None, this is computed when needed.
+    """
+    item = lookup_path(gc, os.path.join(path, annot['parent']))
+    if item is None:
+        if dryrun:
+            return
+        msg = f'Cannot find item {os.path.join(path, annot["parent"])}'
+        raise Exception(msg)
+    if count is None:
+        count = annotation_counts(manifest)[aidx]
+    annotList = gc.get('annotation', parameters={
+        'itemId': item['_id'], 'name': annot['name'], 'limit': 0})
+    if len(annotList) >= count:
+        return
+    logger.info(f'Creating annotation {aidx + 1}/{len(manifest["annotation"])} '
+                f'for {item["name"]}')
+    if dryrun:
+        return
+    filename = os.path.basename(annot['localpath'])
+    temppath = os.path.join(tempdir, f'annotation{aidx}.json')
+    zip_to_file(zf, annot['localpath'], temppath)
+    if annot.get('hasGirderReference'):
+        if itemIds is None:
+            itemIds = uploaded_item_ids(manifest)
+        record = json.load(open(temppath))
+        for el in record['elements']:
+            if 'girderId' in el:
+                if el['girderId'] not in itemIds:
+                    msg = 'No matching uploaded girderId'
+                    raise Exception(msg)
+                el['girderId'] = itemIds[el['girderId']]
+        json.dump(record, open(temppath, 'w'))
+    if 'largeImage' in item and os.path.getsize(temppath) > 1024 ** 2:
+        gc.uploadFileToItem(
+            item['_id'], temppath, mimeType='application/json',
+            filename=filename,
+            reference=json.dumps({
+                'identifier': 'LargeImageAnnotationUpload',
+                'itemId': item['_id'],
+                'fileId': item['largeImage']['fileId'],
+                'userId': get_user_id(gc),
+            }, separators=(',', ':')))
+    else:
+        gc.post('annotation/item/%s' % item['_id'], data=open(temppath, 'rb').read())
+    os.unlink(temppath)
+
+
+def put_item_entries(gc, manifest, path, dryrun, tempdir, zf, imported=None,
+                     workers=4):
+    """
+    Create items, upload files, mark large images, and upload annotations for
+    a demo set.  The manifest is treated as a dependency graph: each item is
+    created before its files are uploaded, its files before it is marked as a
+    large image, and it is marked before its annotations are uploaded.  The
+    chains for different items are independent and are run concurrently.
+    Files whose parent is not a listed item and annotations that reference
+    other items are uploaded after every item chain is complete.  Folders must
+    already exist.
+
+    :param gc: authenticated girder client.
+    :param manifest: the manifest listing the items, files, and annotations.
+    :param path: the base girder resource path for placement.
+    :param dryrun: if True, don't actually create anything.
+    :param tempdir: a temporary directory for extracting files from the
+        zipfile.
+    :param zf: an open zipfile.
+    :param imported: if not None, a colon delimited specification to import
+        rather than upload files.  See put_demo_set.
+    :param workers: the maximum number of concurrent requests.
     """
+    files = {}
+    for fidx, file in enumerate(manifest['file']):
+        files.setdefault(file['parent'], []).append((fidx, file))
+    counts = annotation_counts(manifest)
+    itemIds = {}
+    annots = {}
+    refannots = {}
     for aidx, annot in enumerate(manifest['annotation']):
-        try:
-            item = gc.get('resource/lookup',
-                          parameters={'path': os.path.join(path, annot['parent'])})
-        except Exception:
-            if dryrun:
+        (refannots if annot.get('hasGirderReference') else annots).setdefault(
+            annot['parent'], []).append((aidx, annot))
+
+    def put_item_chain(iidx, item):
+        itempath = os.path.join(item['parent'], item['name'])
+        put_item(gc, manifest, iidx, item, path, dryrun)
+        for fidx, file in files.get(itempath, []):
+            put_file(gc, manifest, fidx, file, path, dryrun, tempdir, zf, imported)
+        if not dryrun:
+            put_mark_large_image(gc, manifest, iidx, item, path, [
+                file for _, file in files.get(itempath, [])])
+        for aidx, annot in annots.get(itempath, []):
+            put_annotation(gc, manifest, aidx, annot, path, dryrun, tempdir, zf,
+                           counts[aidx], itemIds)
+
+    def put_annotation_chain(entries):
+        for aidx, annot in entries:
+            put_annotation(gc, manifest, aidx, annot, path, dryrun, tempdir, zf,
+                           counts[aidx], itemIds)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for future in [pool.submit(put_item_chain, iidx, item)
+                       for iidx, item in enumerate(manifest['item'])]:
+            future.result()
+        itempaths = {os.path.join(item['parent'], item['name']) for item in manifest['item']}
+        for future in [pool.submit(put_file, gc, manifest, fidx, file, path, dryrun,
+                                   tempdir, zf, imported)
+                       for parent, entries in files.items() if parent not in itempaths
+                       for fidx, file in entries]:
+            future.result()
+        itemIds.update(uploaded_item_ids(manifest))
+        for future in [pool.submit(put_annotation_chain, entries)
+                       for entries in refannots.values()]:
+            future.result()
+
+
+JOB_DONE_STATUSES = {3, 4, 5}
+
+
+def job_notifications(gc, since, timeout=60):
+    """
+    Yield job documents from Girder's notification stream as their status
+    changes.  This raises an exception if the stream is unavailable.
+
+    :param gc: the girder client.
+    :param since: only report notifications after this epoch time.
+    :param timeout: the number of seconds the server should keep the stream
+        open.
+    :yields: job documents.
+    """
+    resp = gc.sendRestRequest(
+        'GET', 'notification/stream', parameters={'since': since, 'timeout': timeout},
+        jsonResp=False, stream=True)
+    with resp:
+        for line in resp.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
                 continue
-            raise
-        count = len([a for a in manifest['annotation'][:aidx + 1]
-                     if a['name'] == annot['name'] and a['parent'] == annot['parent']])
-        annotList = gc.get('annotation', parameters={
-            'itemId': item['_id'], 'name': annot['name'], 'limit': 0})
-        if len(annotList) >= count:
-            continue
-        filename = os.path.basename(annot['localpath'])
-        temppath = os.path.join(tempdir, filename)
-        zip_to_file(zf, annot['localpath'], temppath)
-        logger.info(f'Creating annotation {aidx + 1}/{len(manifest["annotation"])} '
-                    f'for {item["name"]}')
-        if dryrun:
-            continue
-        if annot.get('hasGirderReference'):
-            record = json.load(open(temppath))
-            for el in record['elements']:
-                if 'girderId' in el:
-                    for matched in manifest['item']:
-                        if matched['originalId'] == el['girderId']:
-                            el['girderId'] = matched['doc']['_id']
-                            break
-                    else:
-                        msg = 'No matching uploaded girderId'
-                        raise Exception(msg)
-            json.dump(record, open(temppath, 'w'))
-        if 'largeImage' in item and os.path.getsize(temppath) > 1024 ** 2:
-            userId = None
-            user = gc.get('user/me')
-            if user:
-                userId = user['_id']
-            else:
-                token = gc.get('token/current')
-                if token:
-                    userId = token['userId']
-            gc.uploadFileToItem(
-                item['_id'], temppath, mimeType='application/json',
-                filename=filename,
-                reference=json.dumps({
-                    'identifier': 'LargeImageAnnotationUpload',
-                    'itemId': item['_id'],
-                    'fileId': item['largeImage']['fileId'],
-                    'userId': userId,
-                }, separators=(',', ':')))
+            try:
+                event = json.loads(line[5:])
+            except ValueError:
+                continue
+            if event.get('type') == 'job_status' and isinstance(event.get('data'), dict):
+                yield event['data']
+
+
+def wait_for_jobs(gc, jobs):
+    """
+    Wait for a set of jobs to complete.  Job status is taken from Girder's
+    notification stream if it is available; otherwise the jobs are polled with
+    an exponential backoff.
+
+    :param gc: the girder client.
+    :param jobs: a list of girder jobs.
+    :return: a list of the updated girder jobs in the same order.
+    """
+    since = int(time.time()) - 1
+    pending = {job['_id']: job for job in jobs}
+    done = {}
+
+    def finish(job):
+        pending.pop(job['_id'], None)
+        done[job['_id']] = job
+        if job['status'] == 3:
+            logger.debug(f'Job {job["_id"]} done')
         else:
-            gc.post('annotation/item/%s' % item['_id'], data=open(temppath, 'rb').read())
-        os.unlink(temppath)
+            logger.error(f'Job {job["_id"]} failed')
+
+    def poll():
+        for jobId in list(pending):
+            job = gc.get('job/%s' % jobId)
+            if job['status'] in JOB_DONE_STATUSES:
+                finish(job)
+
+    useStream = True
+    delay = 0.25
+    poll()
+    while pending:
+        if useStream:
+            received = False
+            try:
+                for job in job_notifications(gc, since):
+                    received = True
+                    if job.get('_id') in pending and job.get('status') in JOB_DONE_STATUSES:
+                        finish(gc.get('job/%s' % job['_id']))
+                        if not pending:
+                            break
+            except (girder_client.HttpError, requests.RequestException):
+                logger.debug('Notification stream is unavailable; polling jobs')
+                useStream = False
+            poll()
+            # Back off before reconnecting to a stream that closed without
+            # any events so that it isn't reopened in a tight loop
+            if pending and useStream and not received:
+                time.sleep(delay)
+                delay = min(delay * 2, 10)
+            continue
+        logger.debug('.')
+        time.sleep(delay)
+        delay = min(delay * 2, 10)
+        poll()
+    return [done[job['_id']] for job in jobs]
 
 
 def wait_for_job(gc, job):
@@ -328,24 +891,13 @@ def wait_for_job(gc, job):
     :param job: a girder job.
     :return: the updated girder job.
     """
-    lastdot = time.time()
-    jobId = job['_id']
-    while job['status'] not in (3, 4, 5):
-        if time.time() - lastdot >= 5:
-            logger.debug('.')
-            lastdot = time.time()
-        time.sleep(0.25)
-        job = gc.get('job/%s' % jobId)
-    if job['status'] == 3:
-        logger.debug(' done')
-    else:
-        logger.error(' failed')
-    return job
+    return wait_for_jobs(gc, [job])[0]
 
 
-def put_clis(gc, manifest, dryrun):  # noqa
+def put_clis(gc, manifest, dryrun):
     """
-    Upload docker image clis.
+    Upload docker image clis.  All images are submitted before waiting for
+    any of the resulting jobs to finish.
 
     :param gc: authenticated girder client.
     :param manifest: the manifest listing the clis.
@@ -353,17 +905,30 @@ def put_clis(gc, manifest, dryrun):  # noqa
     """
     if manifest.get('cli') is None:
         return
+    jobs = []
     for cli in manifest['cli']:
         logger.info('Adding cli %s ' % cli)
-        gc.put('slicer_cli_web/docker_image', data={'name': '["%s"]' % cli})
-        job = gc.get('job/all', parameters={
-            'sort': 'created', 'sortdir': -1,
-            'types': '["slicer_cli_web_job"]',
-            'limit': 1})[0]
-        wait_for_job(gc, job)
+        if dryrun:
+            continue
+        known = {job['_id'] for job in jobs}
+        job = gc.put('slicer_cli_web/docker_image', data={'name': json.dumps([cli])})
+        if not isinstance(job, dict) or '_id' not in job or 'status' not in job:
+            # Older versions of slicer_cli_web don't return the job, so use
+            # the most recent cli job that we aren't already tracking.
+            job = None
+            for recent in gc.get('job/all', parameters={
+                    'sort': 'created', 'sortdir': -1,
+                    'types': '["slicer_cli_web_job"]',
+                    'limit': len(known) + 1}):
+                if recent['_id'] not in known:
+                    job = recent
+                    break
+        if job is not None:
+            jobs.append(job)
+    wait_for_jobs(gc, jobs)
 
 
-def put_demo_set(gc, demo, path, dryrun=False, imported=None):
+def put_demo_set(gc, demo, path, dryrun=False, imported=None, workers=4):
     """
     Add a demo set to a Girder server.
 
@@ -374,37 +939,210 @@ def put_demo_set(gc, demo, path, dryrun=False, imported=None):
     :param imported: if not None, a colon delimited specification to import
         rather than upload files of the form (local path):(assetstore id):
         (girder path).
+    :param workers: the maximum number of concurrent uploads.
     """
+    gc = DemoSetClient(gc)
     with tempfile.TemporaryDirectory() as tempdir:
-        if not os.path.exists(demo):
-            dest = os.path.join(tempdir, 'temp.zip')
-            logger.info(f'Downloading {demo}')
-            with requests.get(demo, stream=True) as r:
-                r.raise_for_status()
-                with open(dest, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=65536):
-                        f.write(chunk)
-            demo = dest
-        with zipfile.ZipFile(demo, 'r') as zf:
-            manifest = yaml.safe_load(zf.read('manifest.yaml'))
-            if manifest.get('name'):
-                logger.info(f'Name: {manifest["name"]}')
-            if manifest.get('description'):
-                logger.info('Description:')
-                logger.info(manifest['description'])
-            path = path or manifest['destination']
-            put_folders(gc, manifest, path, dryrun)
-            put_items(gc, manifest, path, dryrun)
-            put_files(gc, manifest, path, dryrun, tempdir, zf, imported)
-            if not dryrun:
-                put_mark_large_images(gc, manifest)
-            put_annotations(gc, manifest, path, dryrun, tempdir, zf)
-            put_clis(gc, manifest, dryrun)
+        demo = open_demo_set(demo, tempdir)
+        try:
+            with zipfile.ZipFile(demo, 'r') as zf:
+                manifest = read_manifest(zf)
+                if manifest.get('name'):
+                    logger.info(f'Name: {manifest["name"]}')
+                if manifest.get('description'):
+                    logger.info('Description:')
+                    logger.info(manifest['description'])
+                path = path or manifest['destination']
+                put_folders(gc, manifest, path, dryrun)
+                put_item_entries(gc, manifest, path, dryrun, tempdir, zf, imported, workers)
+                put_clis(gc, manifest, dryrun)
+        finally:
+            if not isinstance(demo, str):
+                demo.close()
+
+
+def load_progress(progress_path, dest_path, resource_path):
+    """
+    Load the progress log of an interrupted demo set creation.  Items that
+    were not completed or whose data is not present in the zip file with the
+    expected size are discarded so that they will be added again, as are the
+    annotations of items whose annotations were not completed.
+
+    :param progress_path: the path of the progress log.
+    :param dest_path: the path of the partial zip file.
+    :param resource_path: the resource path the demo set is being made from.
+    :returns: a progress dictionary or None if creation cannot be resumed.
+    """
+    if not os.path.exists(progress_path) or not os.path.exists(dest_path):
+        return None
+    try:
+        with open(progress_path) as fptr:
+            header = json.loads(fptr.readline())
+            manifest = header['manifest']
+            for key in MANIFEST_LISTS:
+                manifest.setdefault(key, [])
+            completed = set()
+            annotated = set()
+            for line in fptr:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete
+                    break
+                if record.get('model') == 'progress':
+                    completed.update([record['item']] if 'item' in record else [])
+                    annotated.update([record['annotated']] if 'annotated' in record else [])
+                else:
+                    add_manifest_record(manifest, record)
+        with zipfile.ZipFile(dest_path, 'r') as zf:
+            sizes = {zi.filename: zi.file_size for zi in zf.infolist()}
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        logger.warning('Cannot resume creating the demo set; starting over')
+        return None
+    if header.get('resource_path') != resource_path:
+        logger.warning('The existing progress log is for a different resource path')
+        return None
+    bad = {os.path.join(item['parent'], item['name']) for item in manifest['item']
+           if item['originalId'] not in completed}
+    bad |= {file['parent'] for file in manifest['file']
+            if sizes.get(file['localpath']) != file.get('size')}
+    bad |= {annot['parent'] for annot in manifest['annotation']
+            if annot['localpath'] not in sizes}
+    if bad:
+        logger.info(f'Discarding {len(bad)} incomplete items')
+    manifest['item'] = [
+        item for item in manifest['item']
+        if os.path.join(item['parent'], item['name']) not in bad]
+    manifest['file'] = [file for file in manifest['file'] if file['parent'] not in bad]
+    itemIds = {item['originalId'] for item in manifest['item']}
+    annotated &= itemIds
+    annotatedPaths = {os.path.join(item['parent'], item['name'])
+                      for item in manifest['item'] if item['originalId'] in annotated}
+    manifest['annotation'] = [
+        annot for annot in manifest['annotation'] if annot['parent'] in annotatedPaths]
+    logger.info(f'Resuming demo set creation with {len(itemIds)} items')
+    return {
+        'path': progress_path,
+        'resource_path': resource_path,
+        'manifest': manifest,
+        'items': itemIds,
+        'folders': {(folder['parent'], folder['name']) for folder in manifest['folder']},
+        'annotated': annotated,
+    }
 
 
-def create_add_item(gc, zf, manifest, folder, item, base_path, filter=None):
+def compact_partial_zip(dest_path, manifest):
     """
-    Add an item all of its files to a demo set.
+    Remove the members of a partial demo set zip file that the resumed
+    manifest doesn't refer to.  These are the data of discarded items, blobs
+    only they used, annotations that will be written again, and duplicate
+    members.  Members can't be removed from a zip file, so if there is
+    anything to remove, the other members are copied to a new file that
+    replaces the original.
+
+    :param dest_path: the path of the partial zip file.
+    :param manifest: the manifest from load_progress.
+    """
+    keep = ({item['localpath'] + '/' for item in manifest['item']} |
+            {file['localpath'] for file in manifest['file']} |
+            {annot['localpath'] for annot in manifest['annotation']})
+    temp_path = dest_path + '.compact'
+    with zipfile.ZipFile(dest_path, 'r') as zf:
+        infos = zf.infolist()
+        if (len({zi.filename for zi in infos}) == len(infos) and
+                all(zi.filename in keep for zi in infos)):
+            return
+        logger.info('Removing discarded entries from the partial demo set')
+        with zipfile.ZipFile(temp_path, 'w', compression=zipfile.ZIP_DEFLATED) as zout:
+            for zi in infos:
+                if zi.filename not in keep or zi.filename in zout.NameToInfo:
+                    continue
+                if zi.is_dir():
+                    zout.mkdir(zi)
+                    continue
+                with zf.open(zi) as fin, zout.open(zi, 'w') as fout:
+                    shutil.copyfileobj(fin, fout)
+    os.replace(temp_path, dest_path)
+
+
+def start_progress(progress, manifest):
+    """
+    Start the progress log of a demo set creation so that it can be resumed
+    if it is interrupted.  The log is a JSON Lines file that is appended to as
+    entries are completed.  Any existing log is replaced with one that
+    contains the current manifest.
+
+    :param progress: a progress dictionary.
+    :param manifest: the manifest record.
+    """
+    fptr = open(progress['path'], 'w')
+    fptr.write(json.dumps({
+        'resource_path': progress['resource_path'],
+        'manifest': {k: v for k, v in manifest.items() if k not in MANIFEST_LISTS},
+    }, separators=(',', ':')) + '\n')
+    for record in manifest_records(manifest):
+        fptr.write(json.dumps(record, separators=(',', ':')) + '\n')
+    for key in ('items', 'annotated'):
+        for originalId in sorted(progress[key]):
+            fptr.write(json.dumps({
+                'model': 'progress', key.rstrip('s'): originalId}, separators=(',', ':')) + '\n')
+    fptr.flush()
+    progress['fptr'] = fptr
+
+
+def log_progress(progress, records=(), **kwargs):
+    """
+    Append manifest records and a completion marker to the progress log of a
+    demo set creation.
+
+    :param progress: a progress dictionary or None.
+    :param records: an iterable of manifest records to record.
+    :param kwargs: if not empty, a completion marker, either item=(original
+        item id) or annotated=(original item id).
+    """
+    if progress is None:
+        return
+    for record in records:
+        progress['fptr'].write(json.dumps(record, separators=(',', ':')) + '\n')
+    if kwargs:
+        progress['fptr'].write(json.dumps(dict(
+            model='progress', **kwargs), separators=(',', ':')) + '\n')
+    progress['fptr'].flush()
+
+
+def item_source_path(gc, manifest, item, base_path, parent_path):
+    """
+    Get the path of an item relative to the base path from the path of its
+    folder.  If the folder is in the manifest, its path is known; otherwise
+    it is asked for once per folder.
+
+    :param gc: a DemoSetClient.
+    :param manifest: the manifest record.
+    :param item: the girder item document.
+    :param base_path: the girder resource path to use as the context of
+        relative paths.
+    :param parent_path: the path the item is stored under in the demo set.
+        This is used if the item is not below the base path.
+    :returns: the relative item path.
+    """
+    folderId = item['folderId']
+    for folder in manifest['folder']:
+        if folder.get('originalId') == folderId:
+            return os.path.join(folder['parent'], folder['name'], item['name']).strip('/')
+    if folderId not in gc.folderPaths:
+        gc.folderPaths[folderId] = gc.get(
+            f'resource/{folderId}/path', parameters={'type': 'folder'})
+    folder_path = gc.folderPaths[folderId]
+    if folder_path.startswith(base_path):
+        return os.path.join(folder_path[len(base_path):], item['name']).strip('/')
+    return os.path.join(parent_path, item['name']).strip('/')
+
+
+def create_add_item(gc, zf, manifest, folder, item, base_path, filter=None,
+                    progress=None, parent_path=None):
+    """
+    Add an item all of its files to a demo set.  Each distinct file is stored
+    once in the zip file, named by its sha512 hash.
 
     :param gc: authenticated girder client.
     :param zf: open zipfile.
@@ -414,24 +1152,35 @@ def create_add_item(gc, zf, manifest, folder, item, base_path, filter=None):
     :param base_path: the girder resource path to use as the context of
         relative paths.
     :param filter: an optional regex that must validate to store the item.
+    :param progress: an optional progress dictionary.  Items already recorded
+        in it are skipped.
+    :param parent_path: if known, the path of the parent folder relative to
+        the base path.  This avoids asking the server for the item's path.
     """
-    if '_modelType' in folder:
-        folder_path = gc.get(f'resource/{folder.get("_id", folder.get("originalId"))}/path',
-                             parameters={'type': folder['_modelType']})
-        parent_path = (folder_path[len(base_path):].strip('/')
-                       if folder_path.startswith(base_path) else
-                       os.path.join(folder['parent'], folder['name']).strip('/'))
+    if progress is not None and item['_id'] in progress['items']:
+        return
+    if parent_path is not None:
+        item_path = os.path.join(parent_path, item['name']).strip('/')
     else:
-        parent_path = os.path.join(folder['parent'], folder['name']).strip('/')
+        if '_modelType' in folder:
+            folder_path = gc.get(
+                f'resource/{folder.get("_id", folder.get("originalId"))}/path',
+                parameters={'type': folder['_modelType']})
+            parent_path = (folder_path[len(base_path):].strip('/')
+                           if folder_path.startswith(base_path) else
+                           os.path.join(folder['parent'], folder['name']).strip('/'))
+        else:
+            parent_path = os.path.join(folder['parent'], folder['name']).strip('/')
+        item_path = item_source_path(gc, manifest, item, base_path, parent_path)
     dirname = f'item{len(manifest["item"])}'
-    item_path = gc.get(f'resource/{item["_id"]}/path', parameters={'type': 'item'})
-    item_path = (item_path[len(base_path):].strip('/')
-                 if item_path.startswith(base_path) else
-                 os.path.join(parent_path, item['name']).strip('/'))
+    while dirname + '/' in zf.NameToInfo:
+        dirname += '_'
     if filter and not re.search(filter, item_path):
         logger.debug('Filtering out %s', item_path)
         return
     logger.debug(f'Adding item {len(manifest["item"]) + 1} {parent_path}/{item["name"]}')
+    itemidx = len(manifest['item'])
+    fileidx = len(manifest['file'])
     manifest['item'].append({
         'model': 'item',
         'parent': parent_path,
@@ -447,21 +1196,31 @@ def create_add_item(gc, zf, manifest, folder, item, base_path, filter=None):
     with tempfile.TemporaryDirectory() as tempdir:
         for file in gc.listFile(item['_id']):
             logger.info(f'Adding file {parent_path}/{item["name"]}/{file["name"]}')
-            zfpath = os.path.join(dirname, file['name'])
-            temppath = os.path.join(tempdir, file['name'])
-            gc.downloadFile(file['_id'], temppath)
+            sha = file.get('sha512')
+            if not sha or os.path.join('blobs', sha) not in zf.NameToInfo:
+                temppath = os.path.join(tempdir, 'datafile')
+                gc.downloadFile(file['_id'], temppath)
+                sha = sha512_file(temppath)
+                if os.path.join('blobs', sha) not in zf.NameToInfo:
+                    zf.write(temppath, os.path.join('blobs', sha))
+                os.unlink(temppath)
             manifest['file'].append({
                 'model': 'file',
                 'parent': item_path,
                 'name': file['name'],
                 'mimeType': file['mimeType'],
-                'localpath': zfpath,
+                'localpath': os.path.join('blobs', sha),
                 'originalId': file['_id'],
+                'sha512': sha,
+                'size': zf.getinfo(os.path.join('blobs', sha)).file_size,
             })
-            zf.write(temppath, zfpath)
+    if progress is not None:
+        progress['items'].add(item['_id'])
+        log_progress(progress, [manifest['item'][itemidx]] + manifest['file'][fileidx:],
+                     item=item['_id'])
 
 
-def create_add_annotations(gc, zf, manifest, base_path):
+def create_add_annotations(gc, zf, manifest, base_path, progress=None):
     """
     Add annotations for all items in a demo set.  This may add additional
     items (their annotations are not added) and possibly an additional folder
@@ -472,26 +1231,30 @@ def create_add_annotations(gc, zf, manifest, base_path):
     :param manifest: the manifest record to modify.
     :param base_path: the girder resource path to use as the context of
         relative paths.
+    :param progress: an optional progress dictionary.  Items whose
+        annotations are recorded in it are skipped.
     """
     with tempfile.TemporaryDirectory() as tempdir:
         temppath = os.path.join(tempdir, 'annotations.json')
         for item in manifest['item'][:]:
-            item_path = gc.get(f'resource/{item["originalId"]}/path',
-                               parameters={'type': 'item'})
-            parent_path = (item_path[len(base_path):].strip('/')
-                           if item_path.startswith(base_path) else item_path)
+            if progress is not None and item['originalId'] in progress['annotated']:
+                continue
+            parent_path = os.path.join(item['parent'], item['name'])
             annotList = gc.get('annotation', parameters={
                 'itemId': item['originalId'], 'limit': 0})
-            if not len(annotList):
-                continue
+            annotidx = len(manifest['annotation'])
             for aidx, annot in enumerate(annotList):
                 logger.info(f'Getting annotation {aidx}/{len(annotList)} for {item["name"]}')
                 create_add_annotation(gc, zf, manifest, base_path, temppath,
-                                      parent_path, item, aidx, annot)
+                                      parent_path, item, aidx, annot, progress)
+            if progress is not None:
+                progress['annotated'].add(item['originalId'])
+                log_progress(progress, manifest['annotation'][annotidx:],
+                             annotated=item['originalId'])
 
 
 def create_add_annotation(gc, zf, manifest, base_path, temppath, parent_path,
-                          item, aidx, annot):
+                          item, aidx, annot, progress=None):
     """
     Add one annotation for one item in a demo set.  This may add additional
     items (their annotations are not added) and possibly an additional folder
@@ -507,6 +1270,7 @@ def create_add_annotation(gc, zf, manifest, base_path, temppath, parent_path,
     :param item: the item with the annotaton to add.
     :param aidx: a zero-based index of the annotation in the current item.
     :param annot: the annotation to add.
+    :param progress: an optional progress dictionary.
     """
     zfpath = os.path.join(item['localpath'], f'_annotation_{aidx}.json')
     hasGirder = False
@@ -531,11 +1295,17 @@ def create_add_annotation(gc, zf, manifest, base_path, temppath, parent_path,
                         'name': folderName,
                     })
                     folder = manifest['folder'][-1]
+                    log_progress(progress, [folder])
                 else:
                     folder = folder[0]
                 try:
                     annItem = gc.getItem(el.get('girderId'))
-                    create_add_item(gc, zf, manifest, folder, annItem, base_path)
+                    create_add_item(gc, zf, manifest, folder, annItem, base_path,
+                                    progress=progress)
+                    if progress is not None:
+                        # Annotations of referenced items are not added
+                        progress['annotated'].add(annItem['_id'])
+                        log_progress(progress, annotated=annItem['_id'])
                 except Exception:
                     # If we can't access the girder item, we really don't have
                     # permission for this annotation, so we should skip it.
@@ -549,6 +1319,7 @@ def create_add_annotation(gc, zf, manifest, base_path, temppath, parent_path,
                     break
         if hasGirder != 'fail':
             manifest['annotation'].append({
+                'model': 'annotation',
                 'name': record['name'],
                 'parent': os.path.join(item['parent'], item['name']),
                 'localpath': zfpath,
@@ -559,7 +1330,8 @@ def create_add_annotation(gc, zf, manifest, base_path, temppath, parent_path,
         zf.write(temppath, zfpath)
 
 
-def create_add_folder(gc, zf, manifest, folder, max_items, base_path, filter):
+def create_add_folder(gc, zf, manifest, folder, max_items, base_path, filter,
+                      progress=None, parent_path=None):
     """
     Add a folder and all of its subfolders and items to a demo set.
 
@@ -572,11 +1344,16 @@ def create_add_folder(gc, zf, manifest, folder, max_items, base_path, filter):
     :param base_path: the girder resource path to use as the context of
         relative paths.
     :param filter: an optional regex that must validate to store the folder.
+    :param progress: an optional progress dictionary.
+    :param parent_path: if known, the path of the folder relative to the base
+        path.  Paths are carried down the tree, so only the top folder needs
+        to ask the server for its path.
     """
-    folder_path = gc.get(f'resource/{folder["_id"]}/path',
-                         parameters={'type': folder['_modelType']})
-    parent_path = (folder_path[len(base_path):].strip('/')
-                   if folder_path.startswith(base_path) else folder_path)
+    if parent_path is None:
+        folder_path = gc.get(f'resource/{folder["_id"]}/path',
+                             parameters={'type': folder['_modelType']})
+        parent_path = (folder_path[len(base_path):].strip('/')
+                       if folder_path.startswith(base_path) else folder_path)
     if filter and not re.search(filter, parent_path):
         logger.debug('Filtering out %s', parent_path)
         return
@@ -586,7 +1363,8 @@ def create_add_folder(gc, zf, manifest, folder, max_items, base_path, filter):
         for item in gc.listItem(folder['_id']):
             if max_items and len(manifest['item']) >= max_items:
                 return
-            create_add_item(gc, zf, manifest, folder, item, base_path, filter)
+            create_add_item(gc, zf, manifest, folder, item, base_path, filter, progress,
+                            parent_path)
     for subfolder in gc.listFolder(folder['_id'], folder['_modelType']):
         if max_items and len(manifest['item']) >= max_items:
             return
@@ -595,22 +1373,32 @@ def create_add_folder(gc, zf, manifest, folder, max_items, base_path, filter):
             logger.debug('Filtering out %s', folder_path)
             continue
         logger.debug(f'Adding folder {parent_path}/{subfolder["name"]}')
-        manifest['folder'].append({
-            'model': 'folder',
-            'parent': parent_path,
-            'name': subfolder['name'],
-            'description': subfolder.get('description'),
-            'metadata': subfolder.get('meta', {}),
-        })
-        create_add_folder(gc, zf, manifest, subfolder, max_items, base_path, filter)
+        if progress is None or (parent_path, subfolder['name']) not in progress['folders']:
+            manifest['folder'].append({
+                'model': 'folder',
+                'parent': parent_path,
+                'name': subfolder['name'],
+                'description': subfolder.get('description'),
+                'metadata': subfolder.get('meta', {}),
+            })
+            if progress is not None:
+                progress['folders'].add((parent_path, subfolder['name']))
+                log_progress(progress, [manifest['folder'][-1]])
+        create_add_folder(gc, zf, manifest, subfolder, max_items, base_path, filter,
+                          progress, folder_path)
 
 
 def create_demo_set(gc, resource_path, target_path, dest_path, max_items=0,
                     filter=None, cli=None, name=None, description=None,
-                    overwrite=False):
+                    overwrite=False, resume=True, manifest_format='yaml'):
     """
     Create a zip file containing a manifest file, data files, and annotation
-    files.
+    files.  While this is running, a progress log is kept next to the zip
+    file.  If creation is interrupted by an error or a keyboard interrupt,
+    running it again appends to the existing zip file, skipping the items and
+    annotations that were already written.  If the process was killed, the
+    zip file was never closed and can't be read, so creation starts over and
+    replaces it.
 
     :param gc: authenticated girder client.
     :param resource_path: location of the girder server to download.
@@ -622,38 +1410,69 @@ def create_demo_set(gc, resource_path, target_path, dest_path, max_items=0,
     :param filter: if not None, a regex that is applied to resource paths
         during creation.  Only sub resource paths below the containing document
         that validate with this regex are added.
-    :param overwrite: if False and dest_path exists, raise an error.
+    :param overwrite: if False and dest_path exists, raise an error.  This
+        does not apply when resuming.
+    :param resume: if True and there is a progress log from an interrupted
+        run, resume it.  If False, any progress log is discarded.
+    :param manifest_format: 'yaml' or 'jsonl'.  See read_manifest.
     """
+    gc = DemoSetClient(gc)
     resource_path = resource_path.rstrip('/')
     folder = gc.get('resource/lookup', parameters={'path': resource_path})
     if folder['_modelType'] not in {'folder', 'collection'}:
         msg = 'A demo set can only be made from a folder or collection.'
         raise Exception(msg)
-    base_path = os.path.dirname(gc.get(f'resource/{folder["_id"]}/path',
-                                parameters={'type': folder['_modelType']}))
+    folder_path = gc.get(f'resource/{folder["_id"]}/path',
+                         parameters={'type': folder['_modelType']})
+    base_path = os.path.dirname(folder_path)
     logger.debug(f'Adding folder {folder["name"]}')
-    manifest = {
-        'name': name or f'Demo Set of {folder["name"]}',
-        'description': description or '',
-        'destination': os.path.dirname(target_path or resource_path),
-        'folder': [{
-            'model': folder['_modelType'],
-            'parent': '',
-            'name': folder['name'],
-            'description': folder.get('description'),
-            'originalId': folder['_id'],
-            'metadata': folder.get('meta', {}),
-        }],
-        'item': [],
-        'file': [],
-        'annotation': [],
-        'cli': cli if cli else [],
-    }
-    with zipfile.ZipFile(
-            dest_path, 'w' if overwrite else 'x',
-            compression=zipfile.ZIP_DEFLATED) as zf:
-        create_add_folder(gc, zf, manifest, folder, max_items, base_path, filter)
-        create_add_annotations(gc, zf, manifest, base_path)
+    progress_path = dest_path + '.progress.jsonl'
+    progress = load_progress(progress_path, dest_path, resource_path) if resume else None
+    mode = 'w' if overwrite else 'x'
+    if (resume and progress is None and os.path.exists(progress_path) and
+            os.path.exists(dest_path) and not zipfile.is_zipfile(dest_path)):
+        # A progress log next to an unreadable zip file means that a previous
+        # run was killed before it closed the file
+        logger.warning('The partial demo set was not closed cleanly; replacing it')
+        mode = 'w'
+    if progress is not None:
+        manifest = progress.pop('manifest')
+        compact_partial_zip(dest_path, manifest)
+        manifest['cli'] = cli if cli else manifest['cli']
+        mode = 'a'
+    else:
+        progress = {
+            'path': progress_path,
+            'resource_path': resource_path,
+            'items': set(),
+            'folders': set(),
+            'annotated': set(),
+        }
+        manifest = {
+            'name': name or f'Demo Set of {folder["name"]}',
+            'description': description or '',
+            'destination': os.path.dirname(target_path or resource_path),
+            'folder': [{
+                'model': folder['_modelType'],
+                'parent': '',
+                'name': folder['name'],
+                'description': folder.get('description'),
+                'originalId': folder['_id'],
+                'metadata': folder.get('meta', {}),
+            }],
+            'item': [],
+            'file': [],
+            'annotation': [],
+            'cli': cli if cli else [],
+        }
+    with zipfile.ZipFile(dest_path, mode, compression=zipfile.ZIP_DEFLATED) as zf:
+        start_progress(progress, manifest)
+        try:
+            create_add_folder(gc, zf, manifest, folder, max_items, base_path, filter,
+                              progress, folder_path[len(base_path):].strip('/'))
+            create_add_annotations(gc, zf, manifest, base_path, progress)
+        finally:
+            progress['fptr'].close()
         orig = os.path.basename(resource_path)
         dest = os.path.basename(target_path or resource_path)
         if orig != dest and orig == manifest['folder'][0]['name']:
@@ -668,8 +1487,9 @@ def create_demo_set(gc, resource_path, target_path, dest_path, max_items=0,
                 manifest['description'] = f'{len(manifest["item"])} items'
             else:
                 manifest['description'] = ''
-        zf.writestr('manifest.yaml', yaml.dump(
-            manifest, Dumper=IndentDumper, default_flow_style=False, sort_keys=False))
+        write_manifest(zf, manifest, manifest_format)
+    if os.path.exists(progress_path):
+        os.unlink(progress_path)
 
 
 if __name__ == '__main__':
@@ -748,6 +1568,19 @@ if __name__ == '__main__':
     parser.add_argument(
         '--overwrite', '-y', action='store_true',
         help='Allow overwriting an existing output file.')
+    parser.add_argument(
+        '--manifest-format', choices=('yaml', 'jsonl'), default='yaml',
+        help='The manifest format when creating a demo set.  jsonl is faster '
+        'for very large demo sets but needs a recent version of this program '
+        'to install.  The whole manifest is held in memory in either format.')
+    parser.add_argument(
+        '--no-resume', action='store_false', dest='resume',
+        help='When creating a demo set, start over instead of resuming an '
+        'interrupted run.')
+    parser.add_argument(
+        '--workers', '-j', type=int, default=4,
+        help='The maximum number of items to upload concurrently when adding '
+        'a demo set.  Use 1 to upload one entry at a time.')
     opts = parser.parse_args()
     logger.setLevel(max(1, logging.WARNING - (opts.verbose - opts.silent) * 10))
     logger.addHandler(logging.StreamHandler(sys.stderr))
@@ -757,6 +1590,7 @@ if __name__ == '__main__':
     if opts.create:
         create_demo_set(gc, opts.create, opts.path, opts.demo, opts.max_files,
                         opts.filter, opts.cli, opts.name, opts.description,
-                        opts.overwrite)
+                        opts.overwrite, opts.resume, opts.manifest_format)
     else:
-        put_demo_set(gc, opts.demo, opts.path, opts.dry_run, opts.imported)
+        put_demo_set(gc, opts.demo, opts.path, opts.dry_run, opts.imported,
+                     opts.workers)
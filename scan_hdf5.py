@@ -1,18 +1,163 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
 import itertools
+import json
 import math
+import multiprocessing
 import sys
 import time
+import zlib
 
 import h5py
 import numpy as np
 
+from scan_stats import (
+    chunk_stats, fill_stats, merge_stats, print_sample, print_stats, stats_report)
+
 # Inspired from https://stackoverflow.com/a/43374773
 
+# The maximum number of tasks a dataset is split into for parallel analysis
+ANALYZE_TASKS = 256
+# Files opened by worker processes, by path
+_openFiles = {}
+# The maximum number of chunks being compressed while writing a dataset
+MAX_PENDING_CHUNKS = 64
+# Output codecs and their default levels.  The zstd codecs need hdf5plugin.
+CODEC_LEVELS = {'gzip': 9, 'lzf': None, 'blosc-zstd': 5, 'zstd': 3}
+# When tuning output layouts, the target size of chunks in bytes, the number
+# of chunks sampled (and timed reads) for each candidate, and the size of the
+# region read for the tile access pattern
+TUNE_CHUNK_BYTES = 1024 ** 2
+TUNE_SAMPLES = 3
+TUNE_TILE = 256
+# Compressed sizes smaller than this fraction of the raw size are considered
+# equivalent when tuning
+TUNE_MIN_STORED = 0.01
+# HDF5 chunks must be smaller than 4 GiB
+HDF5_MAX_CHUNK_BYTES = 2 ** 32 - 1
+# Output datasets that are not completely written have this attribute with
+# the progress of the conversion, so that it can be resumed
+PROGRESS_ATTR = '_scan_hdf5_progress'
+# Progress is recorded and the output flushed at this interval in seconds
+CHECKPOINT_INTERVAL = 10
+
+
+def chunk_fields(shape, chunks):
+    """
+    Yield the slices of each chunk of a dataset.
+
+    :param shape: the shape of the dataset.
+    :param chunks: the chunk shape of the dataset.
+    :yields: a tuple of slices.
+    """
+    for coor in itertools.product(*(
+            range(0, shape[idx], chunks[idx]) for idx in range(len(shape)))):
+        yield tuple(
+            slice(coor[idx], min(coor[idx] + chunks[idx], shape[idx]))
+            for idx in range(len(shape)))
+
+
+def reduce_chunks(v, fields):
+    """
+    Compute partial statistics over some chunks of a dataset.
+
+    :param v: the dataset.
+    :param fields: a list of tuples of slices of the chunks to read.
+    :returns: a dictionary of statistics.
+    """
+    return merge_stats(itertools.chain(
+        [chunk_stats(np.zeros(0, v.dtype), v.fillvalue)],
+        (chunk_stats(v[field], v.fillvalue) for field in fields)))
+
+
+def reduce_chunks_worker(path, name, fields):
+    """
+    Compute partial statistics in a worker process, opening the file read
+    only the first time it is used.
+
+    :param path: the path of the hdf5 file.
+    :param name: the name of the dataset within the file.
+    :param fields: a list of tuples of slices of the chunks to read.
+    :returns: a dictionary of statistics.
+    """
+    if path not in _openFiles:
+        _openFiles[path] = h5py.File(path, 'r')
+    return reduce_chunks(_openFiles[path][name], fields)
+
+
+def allocated_chunks(v):
+    """
+    Get the chunks of a dataset that have been written, from the chunk index
+    rather than by reading them.  Chunks that aren't allocated are entirely
+    the fill value.
+
+    :param v: the dataset.
+    :returns: a set of the offsets of the allocated chunks, or None if the
+        dataset isn't chunked.
+    """
+    if v.chunks is None:
+        return None
+    offsets = set()
+    try:
+        v.id.chunk_iter(lambda info: offsets.add(info.chunk_offset))
+    except AttributeError:
+        # Older hdf5 libraries
+        for idx in range(v.id.get_num_chunks()):
+            offsets.add(v.id.get_chunk_info(idx).chunk_offset)
+    return offsets
+
+
+def field_allocated(field, chunks, allocated):
+    """
+    Check if any chunk of a dataset that overlaps a region is allocated.
+
+    :param field: a tuple of slices of the region.
+    :param chunks: the chunk shape of the dataset.
+    :param allocated: the set of allocated chunk offsets from
+        allocated_chunks.
+    :returns: True if any overlapping chunk is allocated.
+    """
+    return any(offset in allocated for offset in itertools.product(*(
+        range(s.start // c * c, s.stop, c) for s, c in zip(field, chunks))))
+
+
+def analyze_dataset(v, executor=None):
+    """
+    Compute statistics of a dataset in a single pass, a chunk at a time.  If
+    an executor is given, groups of chunks are reduced in parallel, each
+    worker opening the file itself.  Chunks that aren't allocated are
+    counted as the fill value without being read.
+
+    :param v: the dataset.
+    :param executor: an optional process pool executor.
+    :returns: a dictionary of statistics.
+    """
+    fields = list(chunk_fields(v.shape, v.chunks or v.shape))
+    allocated = allocated_chunks(v)
+    fillstats = []
+    if allocated is not None:
+        allfields = fields
+        fields = [field for field in allfields
+                  if tuple(s.start for s in field) in allocated]
+        fillcount = v.size - sum(
+            math.prod(s.stop - s.start for s in field) for field in fields)
+        if fillcount:
+            fillstats = [fill_stats(v.fillvalue, fillcount, v.dtype)]
+    if executor is None or len(fields) < 2:
+        return merge_stats([reduce_chunks(v, fields)] + fillstats)
+    # Use many more tasks than workers so that uneven chunks balance out
+    tasks = min(len(fields), ANALYZE_TASKS)
+    return merge_stats(itertools.chain(executor.map(
+        reduce_chunks_worker, itertools.repeat(v.file.filename),
+        itertools.repeat(v.name),
+        [fields[idx * len(fields) // tasks:(idx + 1) * len(fields) // tasks]
+         for idx in range(tasks)]), fillstats))
+
 
-def scan_dataset(v, analyze, showattrs, sample, indent):
+def scan_dataset(v, analyze, showattrs, sample, indent, executor=None, report=None):
     minv = maxv = None
     print('%s - %s %s %r %r %s' % (
         '  ' * (indent + 1), v.name, v.dtype, v.shape,
@@ -21,40 +166,346 @@ def scan_dataset(v, analyze, showattrs, sample, indent):
         for ak in v.attrs:
             print('%s   :%s: %r' % ('  ' * (indent + 1), ak, v.attrs[ak]))
     if v.dtype.kind in {'f', 'i'} and analyze:
-        sumv = 0
-        for coor in itertools.product(*(
-                range(0, v.shape[idx], v.chunks[idx]) for idx in range(len(v.shape)))):
-            field = tuple(
-                slice(coor[idx], min(coor[idx] + v.chunks[idx], v.shape[idx]))
-                for idx in range(len(v.shape)))
-            part = v[field]
-            if minv is None:
-                minv = np.amin(part)
-                maxv = np.amax(part)
-            else:
-                minv = min(minv, np.amin(part))
-                maxv = max(maxv, np.amax(part))
-            if part.dtype == np.float16:
-                part = part.astype(np.float32)
-            sumv += part.sum()
-        avgv = sumv / v.size
-        print('%s   [%g,%g] %g' % (
-            '  ' * (indent + 1), minv, maxv, avgv))
+        summary = stats_report(analyze_dataset(v, executor))
+        minv, maxv = summary['min'], summary['max']
+        print_stats(summary, indent)
+        if report is not None:
+            report[v.name] = dict(
+                dtype=str(v.dtype), shape=list(v.shape),
+                chunks=list(v.chunks) if v.chunks else None,
+                compression=v.compression, **summary)
     if sample and len(v.shape) == 1:
-        checksize = int(math.ceil(v.shape[0] ** 0.5))
-        sampleset = np.unique(v[:min(v.shape[0], checksize * 2)])
-        if len(sampleset) < checksize:
-            sampleset = dict(zip(*np.unique(v, return_counts=True)))
-            sampleset = {k: val for val, k in sorted([
-                (val, k) for k, val in sampleset.items()], reverse=True)}
-            if len(sampleset) < max(10, checksize):
-                print('%s   [%d kinds] %r' % (
-                    '  ' * (indent + 1), len(sampleset),
-                    {k: sampleset[k] for k in itertools.islice(sampleset, 100)}))
+        print_sample(v, indent)
     return minv, maxv
 
 
-def write_dataset(k, v, dest, analyze, convert, minv, maxv, indent):
+def checkpoint(destv, progress, chunk):
+    """
+    Record the progress of writing a dataset and flush the output file so an
+    interrupted conversion can be resumed.
+
+    :param destv: the destination dataset.
+    :param progress: a dictionary of the settings used to write the dataset.
+    :param chunk: the index of the first chunk that has not been written.
+        Chunks are written in order.
+    """
+    progress['chunk'] = chunk
+    destv.attrs[PROGRESS_ATTR] = json.dumps(progress)
+    destv.file.flush()
+
+
+def finish_dataset(destv, indent, skip=0, suffix=''):
+    """
+    Mark a dataset as completely written and report it.
+
+    :param destv: the destination dataset.
+    :param indent: the output indentation level.
+    :param skip: the number of chunks that were not written.
+    :param suffix: a string to add to the report.
+    """
+    if PROGRESS_ATTR in destv.attrs:
+        del destv.attrs[PROGRESS_ATTR]
+        destv.file.flush()
+    print('%s > %s %s %r %r %s%s%s' % (
+        '  ' * (indent + 1), destv.name, destv.dtype, destv.shape,
+        destv.chunks, destv.compression, ' %d' % skip if skip else '', suffix))
+
+
+def resume_progress(k, v, dest, dtype):
+    """
+    Check if a dataset was already written to the destination by a previous
+    conversion.
+
+    :param k: the name of the dataset in the destination.
+    :param v: the source dataset.
+    :param dest: the destination group.
+    :param dtype: the expected datatype of a partially written destination.
+    :returns: None if the dataset is not in the destination, True if it is
+        complete, or a dictionary of the recorded progress.  Datasets are
+        marked as partial as soon as they are created, so one without the
+        progress attribute is complete.
+    """
+    if k not in dest:
+        return None
+    destv = dest[k]
+    if not isinstance(destv, h5py.Dataset) or destv.shape != v.shape:
+        msg = '%s in the destination does not match the source' % destv.name
+        raise Exception(msg)
+    if PROGRESS_ATTR not in destv.attrs:
+        return True
+    progress = json.loads(destv.attrs[PROGRESS_ATTR])
+    if not progress.get('raw') and destv.dtype != dtype:
+        msg = '%s in the destination is %s, not %s; it cannot be resumed' % (
+            destv.name, destv.dtype, np.dtype(dtype))
+        raise Exception(msg)
+    return progress
+
+
+def matches_output_filters(v, codec, level):
+    """
+    Check if a dataset is compressed with the same filter pipeline that it
+    would be written with, so its chunks can be copied as stored.
+
+    :param v: the source dataset.
+    :param codec: the output codec or None for the default.
+    :param level: the compression level or None for the default.
+    :returns: True if the filter pipelines match.
+    """
+    if (codec or 'gzip') != 'gzip':
+        return False
+    level = CODEC_LEVELS['gzip'] if level is None else level
+    dcpl = v.id.get_create_plist()
+    filters = [dcpl.get_filter(idx) for idx in range(dcpl.get_nfilters())]
+    expected = ([h5py.h5z.FILTER_SHUFFLE] if v.shuffle else []) + [h5py.h5z.FILTER_DEFLATE]
+    return [f[0] for f in filters] == expected and tuple(filters[-1][2]) == (level,)
+
+
+def copy_raw_chunks(k, v, dest, allocated, indent, progress=None):
+    """
+    Copy a dataset with the same creation properties, copying its allocated
+    chunks as stored without decompressing and recompressing them.
+
+    :param k: the name of the dataset in the destination.
+    :param v: the source dataset.
+    :param dest: the destination group.
+    :param allocated: the set of allocated chunk offsets from
+        allocated_chunks.
+    :param indent: the output indentation level.
+    :param progress: the recorded progress if resuming a partial copy.
+    """
+    lasttime = time.time()
+    if progress is None:
+        destv = h5py.Dataset(h5py.h5d.create(
+            dest.id, k.encode(), v.id.get_type(), v.id.get_space(),
+            dcpl=v.id.get_create_plist()))
+        # Mark the dataset as partial before writing anything else to it
+        progress = {'raw': True}
+        checkpoint(destv, progress, 0)
+        for ak in v.attrs:
+            destv.attrs[ak] = v.attrs[ak]
+    else:
+        destv = dest[k]
+    start = progress['chunk']
+    for cidx, offset in enumerate(sorted(allocated)):
+        if cidx < start:
+            continue
+        if time.time() - lasttime > CHECKPOINT_INTERVAL:
+            sys.stdout.write('  %5.2f%% %r %r %r\r' % (
+                100.0 * cidx / len(allocated), offset, v.shape, v.chunks))
+            sys.stdout.flush()
+            checkpoint(destv, progress, cidx)
+            lasttime = time.time()
+        filterMask, data = v.id.read_direct_chunk(offset)
+        destv.id.write_direct_chunk(offset, data, filterMask)
+    finish_dataset(destv, indent, suffix=' raw')
+
+
+def codec_options(codec, level, shuffle):
+    """
+    Get the create_dataset options for an output codec.
+
+    :param codec: one of the keys of CODEC_LEVELS.
+    :param level: the compression level or None for the default.
+    :param shuffle: True to shuffle the bytes of values before compressing.
+    :returns: a dictionary of options.
+    """
+    level = CODEC_LEVELS[codec] if level is None else level
+    if codec == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': level, 'shuffle': shuffle}
+    if codec == 'lzf':
+        return {'compression': 'lzf', 'shuffle': shuffle}
+    try:
+        import hdf5plugin
+    except ImportError:
+        msg = 'The %s codec requires hdf5plugin' % codec
+        raise Exception(msg)
+    if codec == 'blosc-zstd':
+        return dict(hdf5plugin.Blosc(
+            cname='zstd', clevel=level,
+            shuffle=hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE))
+    return dict(hdf5plugin.Zstd(clevel=level))
+
+
+def can_compress_chunks(codec):
+    """
+    Check if chunks can be compressed in worker processes for an output
+    codec, matching what the hdf5 filter would store.
+
+    :param codec: one of the keys of CODEC_LEVELS.
+    :returns: True if chunks can be compressed directly.
+    """
+    if codec == 'gzip':
+        return True
+    if codec in {'blosc-zstd', 'zstd'}:
+        try:
+            import numcodecs  # noqa: F401
+        except ImportError:
+            return False
+        return True
+    return False
+
+
+def compress_chunk(data, itemsize, codec, level, shuffle):
+    """
+    Compress a chunk the way the hdf5 filter pipeline would, so it can be
+    written with write_direct_chunk.  This is run in worker processes.
+
+    :param data: the bytes of a full chunk.
+    :param itemsize: the size of each value in bytes.
+    :param codec: one of the keys of CODEC_LEVELS for which
+        can_compress_chunks is True.
+    :param level: the compression level or None for the default.
+    :param shuffle: True to shuffle the bytes of values before compressing.
+    :returns: the compressed bytes.
+    """
+    level = CODEC_LEVELS[codec] if level is None else level
+    if codec == 'gzip':
+        if shuffle and itemsize > 1:
+            data = np.frombuffer(data, np.uint8).reshape(-1, itemsize).T.tobytes()
+        return zlib.compress(data, level)
+    import numcodecs
+
+    if codec == 'blosc-zstd':
+        return numcodecs.Blosc(
+            cname='zstd', clevel=level,
+            shuffle=numcodecs.Blosc.SHUFFLE if shuffle else numcodecs.Blosc.NOSHUFFLE,
+            blocksize=0).encode(np.frombuffer(data, 'u%d' % itemsize if itemsize in {
+                1, 2, 4, 8} else np.uint8))
+    return numcodecs.Zstd(level=level).encode(data)
+
+
+def candidate_chunks(shape, dtype):
+    """
+    Get candidate chunk shapes for a dataset: the h5py default, and shapes of
+    about TUNE_CHUNK_BYTES for reading rows, columns, or tiles.  Where a
+    single row or column is larger than HDF5 allows for a chunk, its largest
+    dimensions are halved until it fits.
+
+    :param shape: the shape of the dataset.
+    :param dtype: the numpy dtype of the dataset.
+    :returns: a dictionary of distinct chunk shapes keyed by a description.
+    """
+    with h5py.File('tune', 'w', driver='core', backing_store=False) as mem:
+        candidates = {'auto': mem.create_dataset('d', shape=shape, dtype=dtype, chunks=True).chunks}
+    itemsize = dtype.itemsize
+    rows = TUNE_CHUNK_BYTES // (itemsize * math.prod(shape[1:]))
+    candidates['row'] = (max(1, min(shape[0], rows)),) + tuple(shape[1:])
+    cols = TUNE_CHUNK_BYTES // (itemsize * math.prod(shape[:-1]))
+    candidates['column'] = tuple(shape[:-1]) + (max(1, min(shape[-1], cols)),)
+    side = max(1, int((TUNE_CHUNK_BYTES / itemsize) ** (1 / len(shape))))
+    candidates['tile'] = tuple(min(size, side) for size in shape)
+    distinct = {}
+    for key, chunks in candidates.items():
+        while math.prod(chunks) * itemsize > HDF5_MAX_CHUNK_BYTES:
+            axis = chunks.index(max(chunks))
+            chunks = chunks[:axis] + ((chunks[axis] + 1) // 2,) + chunks[axis + 1:]
+        if chunks not in distinct.values():
+            distinct[key] = chunks
+    return distinct
+
+
+def candidate_codecs(codec, level):
+    """
+    Get candidate codecs for tuning.
+
+    :param codec: a codec that must be used or None.
+    :param level: a compression level that must be used or None.
+    :returns: a list of tuples of codec and level.
+    """
+    if codec:
+        return [(codec, level)]
+    candidates = [('gzip', level)] if level else [('gzip', 4), ('gzip', 9)]
+    candidates.append(('lzf', None))
+    try:
+        import hdf5plugin  # noqa: F401
+    except ImportError:
+        return candidates
+    return candidates + [('zstd', level), ('blosc-zstd', level)]
+
+
+def access_chunks(shape, chunks, access):
+    """
+    Count the chunks read for one access of a dataset.
+
+    :param shape: the shape of the dataset.
+    :param chunks: the chunk shape.
+    :param access: 'row' to read one index of the first axis, 'column' to
+        read one index of the last axis, or 'tile' to read a region of
+        TUNE_TILE along each axis.
+    :returns: the number of chunks read.
+    """
+    if access == 'row':
+        return math.prod(math.ceil(s / c) for s, c in zip(shape[1:], chunks[1:]))
+    if access == 'column':
+        return math.prod(math.ceil(s / c) for s, c in zip(shape[:-1], chunks[:-1]))
+    return math.prod(math.ceil(min(s, TUNE_TILE) / c) for s, c in zip(shape, chunks))
+
+
+def select_layout(v, dtype, access, codec, level, shuffle, fillvalue, indent):
+    """
+    Choose the chunk shape and codec for an output dataset by writing sampled
+    chunks of the source with each candidate to memory.  Candidates are
+    scored by compressed size and by the estimated time to decode the chunks
+    needed for one access, each relative to the best candidate.  Compressed
+    sizes below TUNE_MIN_STORED of the raw size are treated as equal.  The
+    measurements are printed.
+
+    :param v: the source dataset.
+    :param dtype: the numpy dtype of the output.
+    :param access: 'row', 'column', or 'tile'.
+    :param codec: a codec that must be used or None.
+    :param level: a compression level that must be used or None.
+    :param shuffle: True to shuffle bytes before compressing.
+    :param fillvalue: the fill value of the output.
+    :param indent: the output indentation level.
+    :returns: a tuple of chunk shape, codec, and level.
+    """
+    results = []
+    for name, chunks in candidate_chunks(v.shape, dtype).items():
+        full = [max(1, s // c) for s, c in zip(v.shape, chunks)]
+        total = math.prod(full)
+        positions = sorted({np.unravel_index(idx * total // TUNE_SAMPLES, full)
+                            for idx in range(TUNE_SAMPLES)})
+        samples = [v[tuple(slice(p * c, p * c + c) for p, c in zip(pos, chunks))].astype(dtype)
+                   for pos in positions]
+        for ccodec, clevel in candidate_codecs(codec, level):
+            with h5py.File('tune', 'w', driver='core', backing_store=False) as mem:
+                d = mem.create_dataset(
+                    'd', shape=(chunks[0] * len(samples),) + tuple(chunks[1:]),
+                    dtype=dtype, chunks=chunks, fillvalue=fillvalue,
+                    **codec_options(ccodec, clevel, shuffle))
+                for idx, sample in enumerate(samples):
+                    d[idx * chunks[0]:(idx + 1) * chunks[0]] = sample
+                mem.flush()
+                decode = None
+                for _ in range(TUNE_SAMPLES):
+                    start = time.perf_counter()
+                    d[...]
+                    lapse = time.perf_counter() - start
+                    decode = lapse if decode is None else min(decode, lapse)
+                ratio = d.size * d.dtype.itemsize / max(1, d.id.get_storage_size())
+            results.append({
+                'name': name, 'chunks': chunks, 'codec': ccodec, 'level': clevel,
+                'ratio': ratio,
+                'latency': decode / len(samples) * access_chunks(v.shape, chunks, access)})
+    bestStored = max(1 / max(entry['ratio'] for entry in results), TUNE_MIN_STORED)
+    bestLatency = max(min(entry['latency'] for entry in results), 1e-9)
+    for entry in results:
+        entry['score'] = (max(1 / entry['ratio'], TUNE_MIN_STORED) / bestStored +
+                          entry['latency'] / bestLatency)
+    chosen = min(results, key=lambda entry: entry['score'])
+    for entry in results:
+        print('%s   %s %-6s %r %s%s ratio %.2f, %.3f ms per %s%s' % (
+            '  ' * (indent + 1), '*' if entry is chosen else ' ', entry['name'],
+            entry['chunks'], entry['codec'],
+            ' %s' % entry['level'] if entry['level'] is not None else '',
+            entry['ratio'], entry['latency'] * 1000, access,
+            ' (chosen)' if entry is chosen else ''))
+    return chosen['chunks'], chosen['codec'], chosen['level']
+
+
+def write_dataset(k, v, dest, analyze, convert, minv, maxv, indent,  # noqa
+                  executor=None, codec=None, level=None, tune=None):
     lasttime = time.time()
     conv = convert and (v.dtype == np.float64 or (
         v.dtype == np.float32 and convert == 'float16'))
@@ -65,20 +516,52 @@ def write_dataset(k, v, dest, analyze, convert, minv, maxv, indent):
             np.float16)
         if conv == v.dtype:
             conv = False
-    if conv:
-        destv = dest.create_dataset(
-            k, shape=v.shape,
-            dtype=conv,
-            chunks=True, fillvalue=0,
-            compression='gzip', compression_opts=9, shuffle=True)
+    allocated = allocated_chunks(v)
+    progress = resume_progress(k, v, dest, conv or v.dtype)
+    if progress is True:
+        finish_dataset(dest[k], indent, suffix=' done')
+        return
+    # Unless tuning is specified, chunked datasets that don't need conversion
+    # and are already compressed as they would be written are copied as stored
+    if (progress.get('raw') if progress else (
+            not conv and not tune and allocated is not None and
+            matches_output_filters(v, codec, level))):
+        copy_raw_chunks(k, v, dest, allocated, indent, progress)
+        return
+    shuffle = True if conv else v.shuffle
+    if progress:
+        destv = dest[k]
+        codec, level, shuffle = progress['codec'], progress['level'], progress['shuffle']
     else:
-        destv = dest.create_dataset(
-            k, shape=v.shape,
-            dtype=v.dtype,
-            chunks=True, fillvalue=v.fillvalue,
-            compression='gzip', compression_opts=9, shuffle=v.shuffle)
-    for ak in v.attrs:
-        destv.attrs[ak] = v.attrs[ak]
+        chunks = True
+        if (tune and len(v.shape) and v.dtype.kind in {'f', 'i', 'u', 'b'} and
+                v.size * v.dtype.itemsize >= TUNE_CHUNK_BYTES * TUNE_SAMPLES):
+            chunks, codec, level = select_layout(
+                v, np.dtype(conv or v.dtype), tune, codec, level, shuffle,
+                0 if conv else v.fillvalue, indent)
+        codec = codec or 'gzip'
+        if conv:
+            destv = dest.create_dataset(
+                k, shape=v.shape,
+                dtype=conv,
+                chunks=chunks, fillvalue=0,
+                **codec_options(codec, level, shuffle))
+        else:
+            destv = dest.create_dataset(
+                k, shape=v.shape,
+                dtype=v.dtype,
+                chunks=chunks, fillvalue=v.fillvalue,
+                **codec_options(codec, level, shuffle))
+        # Mark the dataset as partial before writing anything else to it
+        progress = {'codec': codec, 'level': level, 'shuffle': shuffle}
+        checkpoint(destv, progress, 0)
+        for ak in v.attrs:
+            destv.attrs[ak] = v.attrs[ak]
+    start = progress['chunk']
+    # Compress chunks in worker processes and write them in order here
+    pipeline = (executor is not None and v.dtype.kind in {'f', 'i', 'u', 'b'} and
+                can_compress_chunks(codec))
+    pending = collections.deque()
     steps = len(list(itertools.product(*(
         range(0, v.shape[idx], destv.chunks[idx])
         for idx in range(len(v.shape))))))
@@ -86,27 +569,48 @@ def write_dataset(k, v, dest, analyze, convert, minv, maxv, indent):
     for cidx, coor in enumerate(itertools.product(*(
             range(0, v.shape[idx], destv.chunks[idx])
             for idx in range(len(v.shape))))):
-        if time.time() - lasttime > 10:
+        if cidx < start:
+            continue
+        if time.time() - lasttime > CHECKPOINT_INTERVAL:
             sys.stdout.write('  %5.2f%% %r %r %r\r' % (
                 100.0 * cidx / steps, coor, v.shape, destv.chunks))
             sys.stdout.flush()
+            checkpoint(destv, progress, pending[0][0] if pending else cidx)
             lasttime = time.time()
         field = tuple(
             slice(coor[idx], min(coor[idx] + destv.chunks[idx], v.shape[idx]))
             for idx in range(len(v.shape)))
+        # Regions that are entirely unallocated in the source are left as
+        # the fill value if it is the same in the destination
+        if (allocated is not None and destv.fillvalue == v.fillvalue and
+                not field_allocated(field, v.chunks, allocated)):
+            skip += 1
+            continue
         part = v[field]
         if conv:
             if not part.any():
                 skip += 1
                 continue
             part = part.astype(conv)
-        destv[field] = part
-    print('%s > %s %s %r %r %s%s' % (
-        '  ' * (indent + 1), destv.name, destv.dtype, destv.shape,
-        destv.chunks, destv.compression,
-        ' %d' % skip if skip else ''))
+        if not pipeline:
+            destv[field] = part
+            continue
+        if part.shape != destv.chunks:
+            full = np.full(destv.chunks, destv.fillvalue, dtype=destv.dtype)
+            full[tuple(slice(0, size) for size in part.shape)] = part
+            part = full
+        pending.append((cidx, tuple(s.start for s in field), executor.submit(
+            compress_chunk, np.ascontiguousarray(part, destv.dtype).tobytes(),
+            destv.dtype.itemsize, codec, level, shuffle)))
+        while len(pending) > MAX_PENDING_CHUNKS:
+            _, offset, future = pending.popleft()
+            destv.id.write_direct_chunk(offset, future.result())
+    while len(pending):
+        _, offset, future = pending.popleft()
+        destv.id.write_direct_chunk(offset, future.result())
+    finish_dataset(destv, indent, skip)
 
-def scan_node(src, dest=None, analyze=False, showattrs=False, convert=None, exclude=None, sample=False, indent=0):  # noqa
+def scan_node(src, dest=None, analyze=False, showattrs=False, convert=None, exclude=None, sample=False, indent=0, executor=None, report=None, codec=None, level=None, tune=None):  # noqa
     if exclude and src.name in exclude:
         return
     print('%s%s' % ('  ' * indent, src.name))
@@ -119,25 +623,51 @@ def scan_node(src, dest=None, analyze=False, showattrs=False, convert=None, excl
         if exclude and v.name in exclude:
             continue
         if isinstance(v, h5py.Dataset):
-            minv, maxv = scan_dataset(v, analyze, showattrs, sample, indent)
+            # Datasets completed by a previous conversion only need to be
+            # analyzed for the report
+            done = (dest is not None and k in dest and
+                    PROGRESS_ATTR not in dest[k].attrs)
+            minv, maxv = scan_dataset(
+                v, analyze and (not done or report is not None), showattrs,
+                sample, indent, executor, report)
             if dest:
-                write_dataset(k, v, dest, analyze, convert, minv, maxv, indent)
+                write_dataset(k, v, dest, analyze, convert, minv, maxv, indent,
+                              executor, codec, level, tune)
         elif isinstance(v, h5py.Group):
             destv = None
             if dest:
-                destv = dest.create_group(k)
-            scan_node(v, destv, analyze, showattrs, convert, exclude, sample, indent=indent + 1)
+                destv = dest.require_group(k)
+            scan_node(v, destv, analyze, showattrs, convert, exclude, sample,
+                      indent=indent + 1, executor=executor, report=report,
+                      codec=codec, level=level, tune=tune)
 
 
 def scan_hdf5(path, analyze=False, showattrs=False, outpath=None, convert=None,
-              exclude=None, sample=False):
-    if convert:
+              exclude=None, sample=False, workers=None, jsonpath=None,
+              codec=None, level=None, tune=None, resume=False):
+    if convert or jsonpath:
         analyze = True
-    with h5py.File(path, 'r') as fptr:
-        fptr2 = None
-        if outpath:
-            fptr2 = h5py.File(outpath, 'w')
-        scan_node(fptr, fptr2, analyze, showattrs, convert, exclude, sample)
+    report = {} if jsonpath else None
+    executor = None
+    if (analyze or outpath) and workers != 1:
+        # Workers are spawned rather than forked so they don't inherit the
+        # hdf5 library state of this process
+        executor = concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        with h5py.File(path, 'r') as fptr:
+            fptr2 = None
+            if outpath:
+                fptr2 = h5py.File(outpath, 'a' if resume else 'w')
+            scan_node(fptr, fptr2, analyze, showattrs, convert, exclude, sample,
+                      executor=executor, report=report, codec=codec, level=level,
+                      tune=tune)
+    finally:
+        if executor:
+            executor.shutdown()
+    if jsonpath:
+        with open(jsonpath, 'w') as fptr:
+            json.dump({'source': path, 'datasets': report}, fptr, indent=2)
 
 
 def command():
@@ -150,7 +680,9 @@ def command():
         'source', type=str, help='Source file to read and analyze.')
     parser.add_argument(
         '--analyze', '-s', action='store_true',
-        help='Analyze the min/max/average of datasets.')
+        help='Analyze datasets, reporting the min/max/mean, standard '
+        'deviation, NaN and infinite counts, and zero and fill value '
+        'fractions in a single pass.')
     parser.add_argument(
         '--sample', action='store_true',
         help='Show a sample of 1-d data sets if they have fewer unique values '
@@ -166,9 +698,38 @@ def command():
     parser.add_argument(
         '--exclude', action='append',
         help='Exclude a dataset or group from the output file.')
+    parser.add_argument(
+        '--workers', '-j', type=int,
+        help='The number of processes used to analyze datasets and compress '
+        'output chunks.  Default is the number of CPUs.')
+    parser.add_argument(
+        '--codec', choices=list(CODEC_LEVELS),
+        help='The compression codec for the output file.  The zstd codecs '
+        'require hdf5plugin.  If not specified, gzip is used and datasets '
+        'that are already compressed and not converted are copied as stored.')
+    parser.add_argument(
+        '--level', type=int,
+        help='The compression level for the output file.  The default depends '
+        'on the codec; it is 9 for gzip.')
+    parser.add_argument(
+        '--tune', choices=('row', 'column', 'tile'),
+        help='Choose the output chunk shape and codec of each large dataset '
+        'for reading it by rows, columns, or tiles.  Candidates are measured '
+        'on sampled chunks for compression ratio and read time, and the '
+        'results are reported.  A specified codec or level is kept.')
+    parser.add_argument(
+        '--json',
+        help='Write the analysis of each dataset, including a histogram by '
+        'powers of two, to this path as JSON.  This implies --analyze.')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Continue an interrupted conversion, keeping the datasets and '
+        'chunks already written to the destination file.  Progress is '
+        'recorded in the destination every %d seconds.' % CHECKPOINT_INTERVAL)
     opts = parser.parse_args()
     scan_hdf5(opts.source, opts.analyze, opts.attrs, opts.dest, opts.convert,
-              opts.exclude, opts.sample)
+              opts.exclude, opts.sample, opts.workers, opts.json, opts.codec,
+              opts.level, opts.tune, opts.resume)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,261 @@
+import hashlib
+import itertools
+import math
+
+import numpy as np
+
+# Histogram bins are by sign and the exponent from np.frexp; the exponent is
+# offset so that bin numbers are not negative
+HISTOGRAM_OFFSET = 1100
+# When sampling values, the number of hashes kept to estimate the number of
+# distinct values, the number of common values tracked once there are too
+# many to count exactly, and the minimum number of values read at once
+SKETCH_SIZE = 1024
+HEAVY_HITTERS = 100
+SAMPLE_BLOCK = 1024 ** 2
+
+
+def chunk_stats(part, fill):
+    """
+    Compute statistics of one chunk of data.  Minimum, maximum, mean, and
+    variance are of the finite values.  The histogram has a bin for each
+    sign and power of two of the nonzero finite values.
+
+    :param part: a numpy array.
+    :param fill: the fill value of the dataset or None.
+    :returns: a dictionary of statistics that can be combined with
+        merge_stats.
+    """
+    part = np.asarray(part).ravel()
+    stats = {
+        'count': part.size,
+        'nan': 0,
+        'posinf': 0,
+        'neginf': 0,
+        'zero': int(np.count_nonzero(part == 0)),
+        'fill': 0 if fill is None else int(np.count_nonzero(
+            np.isnan(part) if fill != fill else part == fill)),
+        'finite': 0,
+        'min': None,
+        'max': None,
+        'mean': 0.0,
+        'm2': 0.0,
+        'histogram': {},
+    }
+    vals = part
+    if part.dtype.kind == 'f':
+        finite = np.isfinite(part)
+        if not finite.all():
+            stats['nan'] = int(np.count_nonzero(np.isnan(part)))
+            stats['posinf'] = int(np.count_nonzero(np.isposinf(part)))
+            stats['neginf'] = int(np.count_nonzero(np.isneginf(part)))
+            vals = part[finite]
+    if vals.size:
+        stats['min'] = vals.min().item()
+        stats['max'] = vals.max().item()
+        vals = vals.astype(np.float64)
+        stats['finite'] = vals.size
+        stats['mean'] = vals.mean().item()
+        stats['m2'] = np.square(vals - stats['mean']).sum().item()
+        vals = vals[vals != 0]
+        bins = np.bincount((np.frexp(vals)[1].astype(np.int64) + HISTOGRAM_OFFSET) * 2 +
+                           (vals < 0))
+        stats['histogram'] = {int(key): int(bins[key]) for key in np.flatnonzero(bins)}
+    return stats
+
+
+def fill_stats(fill, count, dtype):
+    """
+    Compute the statistics of chunks that are entirely the fill value.
+
+    :param fill: the fill value.
+    :param count: the number of values.
+    :param dtype: the numpy dtype of the dataset.
+    :returns: a dictionary of statistics.
+    """
+    stats = chunk_stats(np.array([fill], dtype=dtype), fill)
+    for key in ('count', 'nan', 'posinf', 'neginf', 'zero', 'fill', 'finite'):
+        stats[key] *= count
+    stats['histogram'] = {key: val * count for key, val in stats['histogram'].items()}
+    return stats
+
+
+def merge_stats(stats):
+    """
+    Merge partial statistics.  The means and variances are combined with
+    Chan's parallel form of Welford's algorithm.
+
+    :param stats: an iterable of at least one dictionary of statistics.
+    :returns: a dictionary of statistics.
+    """
+    total = None
+    for part in stats:
+        if total is None:
+            total = dict(part, histogram=dict(part['histogram']))
+            continue
+        for key in ('count', 'nan', 'posinf', 'neginf', 'zero', 'fill'):
+            total[key] += part[key]
+        if part['finite'] and not total['finite']:
+            for key in ('finite', 'min', 'max', 'mean', 'm2'):
+                total[key] = part[key]
+        elif part['finite']:
+            total['min'] = min(total['min'], part['min'])
+            total['max'] = max(total['max'], part['max'])
+            count = total['finite'] + part['finite']
+            delta = part['mean'] - total['mean']
+            total['mean'] += delta * part['finite'] / count
+            total['m2'] += part['m2'] + delta ** 2 * total['finite'] * part['finite'] / count
+            total['finite'] = count
+        for key, val in part['histogram'].items():
+            total['histogram'][key] = total['histogram'].get(key, 0) + val
+    return total
+
+
+def stats_report(stats):
+    """
+    Summarize statistics in a form that can be written as JSON.
+
+    :param stats: a dictionary of statistics.
+    :returns: a dictionary with counts, fractions, minimum, maximum, mean,
+        population variance and standard deviation, and a list of histogram
+        bins with low, high, and count.
+    """
+    histogram = []
+    for key, val in stats['histogram'].items():
+        exp = key // 2 - HISTOGRAM_OFFSET
+        low, high = math.ldexp(1.0, exp - 1), 2 * math.ldexp(1.0, exp - 1)
+        if key % 2:
+            low, high = -high, -low
+        histogram.append({'low': low, 'high': high, 'count': val})
+    variance = stats['m2'] / stats['finite'] if stats['finite'] else None
+    return {
+        'count': stats['count'],
+        'finite': stats['finite'],
+        'nan': stats['nan'],
+        'posinf': stats['posinf'],
+        'neginf': stats['neginf'],
+        'zero_fraction': stats['zero'] / stats['count'] if stats['count'] else None,
+        'fill_fraction': stats['fill'] / stats['count'] if stats['count'] else None,
+        'min': stats['min'],
+        'max': stats['max'],
+        'mean': stats['mean'] if stats['finite'] else None,
+        'variance': variance,
+        'std': math.sqrt(variance) if variance is not None else None,
+        'histogram': sorted(histogram, key=lambda entry: entry['low']),
+    }
+
+
+def print_stats(summary, indent):
+    """
+    Print a summary of statistics.
+
+    :param summary: a summary from stats_report.
+    :param indent: the output indentation level.
+    """
+    if summary['finite']:
+        print('%s   [%g,%g] %g' % (
+            '  ' * (indent + 1), summary['min'], summary['max'], summary['mean']))
+    print('%s   std %s, nan %d, inf %d, zero %.2f%%, fill %.2f%%' % (
+        '  ' * (indent + 1),
+        '%g' % summary['std'] if summary['std'] is not None else '-',
+        summary['nan'], summary['posinf'] + summary['neginf'],
+        100 * (summary['zero_fraction'] or 0), 100 * (summary['fill_fraction'] or 0)))
+
+
+def value_hashes(values):
+    """
+    Hash values to uniformly distributed 64-bit integers.
+
+    :param values: a numpy array of values.
+    :returns: a numpy uint64 array of hashes.
+    """
+    if values.dtype.kind in {'f', 'i', 'u', 'b'} and values.dtype.itemsize in {1, 2, 4, 8}:
+        if values.dtype.kind == 'f':
+            # Make all NaNs and zeros hash the same
+            values = np.where(np.isnan(values), np.nan, values + 0).astype(values.dtype)
+        keys = values.view('u%d' % values.dtype.itemsize).astype(np.uint64)
+        # splitmix64 finalizer
+        keys = keys + np.uint64(0x9E3779B97F4A7C15)
+        keys = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        keys = (keys ^ (keys >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return keys ^ (keys >> np.uint64(31))
+    return np.array([
+        int.from_bytes(hashlib.blake2b(repr(val).encode(), digest_size=8).digest(), 'little')
+        for val in values.tolist()], dtype=np.uint64)
+
+
+def prune_counts(counts, size):
+    """
+    Reduce a Misra-Gries summary to at most a number of entries by
+    subtracting the next largest count from all counts.
+
+    :param counts: a dictionary of values and counts.
+    :param size: the maximum number of entries to keep.
+    :returns: a dictionary of values and counts.
+    """
+    if len(counts) <= size:
+        return counts
+    threshold = sorted(counts.values(), reverse=True)[size]
+    return {val: count - threshold for val, count in counts.items() if count > threshold}
+
+
+def sample_values(v, limit):
+    """
+    Count the distinct values of a 1-d dataset chunk by chunk.  Values are
+    counted exactly until there are more than a limit of them.  After that,
+    the number of distinct values is estimated with a k-minimum-values sketch
+    and the most common values are tracked with a Misra-Gries summary, so
+    memory use is bounded by the read size rather than the dataset size.
+
+    :param v: a 1-d dataset.
+    :param limit: the maximum number of distinct values to count exactly.
+    :returns: a dictionary of values and counts sorted by decreasing count,
+        the number of distinct values, and True if these are exact.  When not
+        exact, the counts are lower bounds for the most common values and
+        the number of distinct values is an estimate.
+    """
+    step = v.chunks[0] if v.chunks else 1
+    step *= max(1, SAMPLE_BLOCK // step)
+    counts = {}
+    exact = True
+    hashes = np.zeros(0, np.uint64)
+    for start in range(0, v.shape[0], step):
+        values, valcounts = np.unique(v[start:start + step], return_counts=True)
+        hashes = np.unique(np.concatenate([hashes, value_hashes(values)]))[:SKETCH_SIZE]
+        exact = exact and len(values) <= limit
+        if not exact and len(values) > HEAVY_HITTERS:
+            top = np.argpartition(valcounts, -HEAVY_HITTERS - 1)[-HEAVY_HITTERS - 1:]
+            values, valcounts = values[top], valcounts[top] - valcounts[top].min()
+        for val, count in zip(values.tolist(), valcounts.tolist()):
+            if val != val:
+                val = math.nan
+            if count:
+                counts[val] = counts.get(val, 0) + count
+        if not exact or len(counts) > limit:
+            exact = False
+            counts = prune_counts(counts, HEAVY_HITTERS)
+    counts = dict(sorted(counts.items(), key=lambda item: (item[1], item[0]), reverse=True))
+    if exact:
+        return counts, len(counts), True
+    kinds = len(hashes)
+    if kinds >= SKETCH_SIZE:
+        kinds = int(round((SKETCH_SIZE - 1) * 2.0 ** 64 / float(hashes[-1])))
+    return counts, kinds, False
+
+
+def print_sample(v, indent):
+    """
+    Print the distinct values of a 1-d dataset if it has fewer than the
+    square root of its length of them.
+
+    :param v: the 1-d dataset or array.
+    :param indent: the indentation level of the dataset.
+    """
+    checksize = int(math.ceil(v.shape[0] ** 0.5))
+    sampleset = np.unique(v[:min(v.shape[0], checksize * 2)])
+    if len(sampleset) < checksize:
+        sampleset, kinds, exact = sample_values(v, max(10, checksize) - 1)
+        print('%s   [%s%d kinds] %s%r' % (
+            '  ' * (indent + 1), '' if exact else '~', kinds,
+            '' if exact else 'top ',
+            {k: sampleset[k] for k in itertools.islice(sampleset, 100)}))
@@ -1,14 +1,25 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import itertools
+import json
 import math
 import os
 import pprint
+import shutil
+import tempfile
+import zipfile
 
 import numpy as np
 import zarr
 
+from scan_stats import (
+    chunk_stats, fill_stats, merge_stats, print_sample, print_stats, stats_report)
+
+# The maximum number of tasks an array is split into for parallel analysis
+ANALYZE_TASKS = 256
+
 
 def show_attrs(src, indent):
     for ak in src.attrs:
@@ -25,7 +36,159 @@ def show_attrs(src, indent):
             print('%s:%s: %r' % ('  ' * indent, ak, src.attrs[ak]))
 
 
-def scan_dataset(v, analyze, showattrs, sample, empty, indent):
+def chunk_keys(v):
+    """
+    List the keys of the chunks of an array that exist in its store.  This
+    lists the store rather than checking every chunk position, so it is
+    proportional to the number of stored chunks.
+
+    :param v: a zarr array.
+    :returns: a list of chunk keys relative to the root of the store.
+    """
+    store = v.chunk_store
+    prefix = v.path + '/' if v.path else ''
+    keys = [key for key in zarr.storage.listdir(store, v.path) if not key.startswith('.z')]
+    if getattr(v, '_dimension_separator', None) == '/':
+        for _ in range(len(v.shape) - 1):
+            keys = ['%s/%s' % (key, sub) for key in keys
+                    for sub in zarr.storage.listdir(store, prefix + key)]
+    return [prefix + key for key in keys]
+
+
+def stored_fields(v):
+    """
+    Get the regions of the chunks of an array that exist in its store.
+
+    :param v: a zarr array.
+    :returns: a sorted list of tuples of slices of the stored chunks.
+    """
+    prefix = v.path + '/' if v.path else ''
+    separator = getattr(v, '_dimension_separator', None) or '.'
+    fields = []
+    for key in chunk_keys(v):
+        try:
+            coor = [int(part) for part in key[len(prefix):].split(separator)]
+        except ValueError:
+            continue
+        if len(coor) != len(v.shape):
+            continue
+        fields.append(tuple(
+            slice(coor[idx] * v.chunks[idx], min((coor[idx] + 1) * v.chunks[idx], v.shape[idx]))
+            for idx in range(len(v.shape))))
+    return sorted(fields, key=lambda field: tuple(s.start for s in field))
+
+
+def reduce_chunks(v, fields):
+    """
+    Compute partial statistics over some chunks of an array.
+
+    :param v: the array.
+    :param fields: a list of tuples of slices of the chunks to read.
+    :returns: a dictionary of statistics.
+    """
+    return merge_stats(itertools.chain(
+        [chunk_stats(np.zeros(0, v.dtype), v.fill_value)],
+        (chunk_stats(v[field], v.fill_value) for field in fields)))
+
+
+def analyze_array(v, executor=None):
+    """
+    Compute statistics of an array in a single pass, a chunk at a time.  The
+    stored chunks are listed first; missing chunks are counted as the fill
+    value without being read.  If an executor is given, groups of stored
+    chunks are decompressed and reduced in parallel.
+
+    :param v: the array.
+    :param executor: an optional thread pool executor.
+    :returns: a dictionary of statistics.
+    """
+    fillstats = []
+    if v.fill_value is None or not len(v.shape):
+        # Missing chunks don't have a defined value, so read every position
+        fields = [tuple(
+            slice(coor[idx], min(coor[idx] + v.chunks[idx], v.shape[idx]))
+            for idx in range(len(v.shape))) for coor in itertools.product(*(
+                range(0, v.shape[idx], v.chunks[idx]) for idx in range(len(v.shape))))]
+    else:
+        fields = stored_fields(v)
+        fillcount = v.size - sum(
+            math.prod(s.stop - s.start for s in field) for field in fields)
+        if fillcount:
+            fillstats = [fill_stats(v.fill_value, fillcount, v.dtype)]
+    if executor is None or len(fields) < 2:
+        return merge_stats([reduce_chunks(v, fields)] + fillstats)
+    # Use many more tasks than workers so that uneven chunks balance out
+    tasks = min(len(fields), ANALYZE_TASKS)
+    return merge_stats(itertools.chain(executor.map(
+        reduce_chunks, itertools.repeat(v),
+        [fields[idx * len(fields) // tasks:(idx + 1) * len(fields) // tasks]
+         for idx in range(tasks)]), fillstats))
+
+
+def empty_array(v, value, emptied=None):
+    """
+    Make every value of an array a constant by deleting its chunks and
+    setting its fill value.  This is proportional to the number of stored
+    chunks rather than the size of the data.
+
+    :param v: a zarr array.
+    :param value: the new fill value.
+    :param emptied: if not None, a dictionary to record the array path and
+        new fill value in instead of changing the store.  This is used for
+        stores that can't delete keys.
+    """
+    if emptied is not None:
+        emptied[v.path] = value
+        return
+    store = v.chunk_store
+    for key in chunk_keys(v):
+        del store[key]
+    if getattr(v, '_dimension_separator', None) == '/' and len(v.shape) > 1:
+        # Nested stores keep a directory for each leading chunk index, which
+        # zarr still counts as stored chunks when they are empty
+        prefix = v.path + '/' if v.path else ''
+        for key in zarr.storage.listdir(store, v.path):
+            if not key.startswith('.z'):
+                zarr.storage.rmdir(store, prefix + key)
+    v.fill_value = value
+
+
+def rewrite_zip(path, emptied):
+    """
+    Rewrite a zip store without the chunks of emptied arrays and with their
+    fill values changed.  Members can't be removed from a zip file, so the
+    other members are copied to a new file which then replaces the original.
+
+    :param path: the path of the zip file.
+    :param emptied: a dictionary of array paths and new fill values from
+        empty_array.
+    """
+    fd, tmppath = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix='.zip')
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(path) as zin, zipfile.ZipFile(
+                tmppath, 'w', allowZip64=True) as zout:
+            for info in zin.infolist():
+                parts = info.filename.split('/')
+                array = next((
+                    '/'.join(parts[:idx]) for idx in range(len(parts) - 1, -1, -1)
+                    if '/'.join(parts[:idx]) in emptied), None)
+                if array is not None and parts[-1] == '.zarray':
+                    meta = json.loads(zin.read(info))
+                    meta['fill_value'] = emptied[array]
+                    zout.writestr(info, json.dumps(meta, indent=4, sort_keys=True))
+                elif array is None or parts[-1].startswith('.z'):
+                    with zin.open(info) as fin, zout.open(info, 'w') as fout:
+                        shutil.copyfileobj(fin, fout)
+        os.replace(tmppath, path)
+    finally:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+
+
+def scan_dataset(v, analyze, showattrs, sample, empty, indent, report=None,
+                 emptied=None, executor=None):
     minv = maxv = None
     if empty is not False:
         empty = empty + 1 if empty is not True else 0
@@ -35,72 +198,93 @@ def scan_dataset(v, analyze, showattrs, sample, empty, indent):
     if showattrs:
         show_attrs(v, indent + 1)
     if v.dtype.kind in {'f', 'i', 'u'} and empty is not False:
-        v[...] = empty
+        empty_array(v, empty, emptied)
+    # Arrays in stores that are rewritten after the scan are reported with
+    # the values they will have
+    deferred = emptied is not None and v.path in emptied
     if v.dtype.kind in {'f', 'i', 'u'} and analyze:
-        sumv = 0
-        for coor in itertools.product(*(
-                range(0, v.shape[idx], v.chunks[idx]) for idx in range(len(v.shape)))):
-            field = tuple(
-                slice(coor[idx], min(coor[idx] + v.chunks[idx], v.shape[idx]))
-                for idx in range(len(v.shape)))
-            part = v[field]
-            if minv is None:
-                minv = np.amin(part)
-                maxv = np.amax(part)
-            else:
-                minv = min(minv, np.amin(part))
-                maxv = max(maxv, np.amax(part))
-            if part.dtype == np.float16:
-                part = part.astype(np.float32)
-            sumv += part.sum()
-        avgv = sumv / v.size
-        print('%s   [%g,%g] %g' % (
-            '  ' * (indent + 1), minv, maxv, avgv))
-    if sample and len(v.shape) == 1:
-        checksize = int(math.ceil(v.shape[0] ** 0.5))
-        sampleset = np.unique(v[:min(v.shape[0], checksize * 2)])
-        if len(sampleset) < checksize:
-            sampleset = dict(zip(*np.unique(v, return_counts=True)))
-            sampleset = {k: val for val, k in sorted([
-                (val, k) for k, val in sampleset.items()], reverse=True)}
-            if len(sampleset) < max(10, checksize):
-                print('%s   [%d kinds] %r' % (
-                    '  ' * (indent + 1), len(sampleset),
-                    {k: sampleset[k] for k in itertools.islice(sampleset, 100)}))
+        summary = stats_report(
+            fill_stats(emptied[v.path], v.size, v.dtype) if deferred else
+            analyze_array(v, executor))
+        minv, maxv = summary['min'], summary['max']
+        print_stats(summary, indent)
+        if report is not None:
+            report[v.name] = dict(
+                dtype=str(v.dtype), shape=list(v.shape), chunks=list(v.chunks),
+                compressor=v.compressor.cname if v.compressor else None, **summary)
+    if sample and len(v.shape) == 1 and deferred:
+        print('%s   [1 kinds] %r' % ('  ' * (indent + 1), {emptied[v.path]: v.shape[0]}))
+    elif sample and len(v.shape) == 1:
+        print_sample(v, indent)
     return minv, maxv, empty
 
 
-def scan_node(src, analyze=False, showattrs=False, sample=False, empty=False, indent=0):
+def scan_node(src, analyze=False, showattrs=False, sample=False, empty=False, indent=0,
+              report=None, emptied=None, executor=None):
     print('%s%s' % ('  ' * indent, src.name))
     if showattrs:
         show_attrs(src, indent)
     for _k, v in src.items():
         if isinstance(v, zarr.core.Array):
-            minv, maxv, empty = scan_dataset(v, analyze, showattrs, sample, empty, indent)
+            minv, maxv, empty = scan_dataset(
+                v, analyze, showattrs, sample, empty, indent, report, emptied, executor)
         elif isinstance(v, zarr.hierarchy.Group):
-            empty = scan_node(v, analyze, showattrs, sample, empty, indent=indent + 1)
+            empty = scan_node(
+                v, analyze, showattrs, sample, empty, indent=indent + 1, report=report,
+                emptied=emptied, executor=executor)
     return empty
 
 
-def scan_zarr(path, analyze=False, showattrs=False, sample=False, empty=False):
+def scan_zarr(path, analyze=False, showattrs=False, sample=False, empty=False,  # noqa
+              jsonpath=None, workers=None):
+    if jsonpath:
+        analyze = True
+    report = {} if jsonpath else None
     if os.path.isdir(path):
         if (not os.path.exists(os.path.join(path, '.zgroup')) and
                 not os.path.exists(os.path.join(path, '.zattrs')) and
                 not os.path.exists(os.path.join(path, '.zarray'))):
             print(f'Cannot parse {path}')
             return
+    # Zip stores are read and then rewritten if they are emptied
+    emptied = {} if empty and zipfile.is_zipfile(path) else None
     try:
         fptr = zarr.open(zarr.SQLiteStore(str(path)))
     except Exception:
         try:
-            fptr = zarr.open(path, mode='r' if not empty else 'r+')
+            if emptied is not None:
+                fptr = zarr.open(zarr.ZipStore(path, mode='r'), mode='r')
+            else:
+                fptr = zarr.open(path, mode='r' if not empty else 'r+')
         except Exception:
             print(f'Cannot parse {path}')
             return
-    if isinstance(fptr, zarr.core.Array):
-        scan_dataset(fptr, analyze, showattrs, sample, empty, 0)
-    else:
-        scan_node(fptr, analyze, showattrs, sample, empty)
+    executor = None
+    # Decompression and numpy reductions release the GIL, so threads are
+    # used and the store doesn't need to be reopened by workers.  SQLite
+    # stores share one cursor that isn't safe to use from several threads.
+    if analyze and workers != 1 and not isinstance(fptr.store, zarr.SQLiteStore):
+        executor = concurrent.futures.ThreadPoolExecutor(workers)
+    try:
+        if isinstance(fptr, zarr.core.Array):
+            scan_dataset(fptr, analyze, showattrs, sample, empty, 0, report, emptied,
+                         executor)
+        else:
+            scan_node(fptr, analyze, showattrs, sample, empty, report=report,
+                      emptied=emptied, executor=executor)
+    finally:
+        if executor:
+            executor.shutdown()
+    if emptied:
+        fptr.store.close()
+        rewrite_zip(path, emptied)
+    elif empty and isinstance(fptr.store, zarr.SQLiteStore):
+        # Deleting rows leaves free pages in the database; reclaim them so
+        # the file shrinks
+        fptr.store.cursor.execute('VACUUM')
+    if jsonpath:
+        with open(jsonpath, 'w') as fptr:
+            json.dump({'source': path, 'datasets': report}, fptr, indent=2)
 
 
 def command():
@@ -112,7 +296,9 @@ def command():
         'source', type=str, help='Source file to read and analyze.')
     parser.add_argument(
         '--analyze', '-s', action='store_true',
-        help='Analyze the min/max/average of datasets.')
+        help='Analyze datasets, reporting the min/max/mean, standard '
+        'deviation, NaN and infinite counts, and zero and fill value '
+        'fractions in a single pass.')
     parser.add_argument(
         '--sample', action='store_true',
         help='Show a sample of 1-d data sets if they have fewer unique values '
@@ -122,10 +308,20 @@ def command():
         help='Show attributes on groups and datasets.')
     parser.add_argument(
         '--empty', action='store_true',
-        help='Modify the file, making all arrays a constant value.')
+        help='Modify the file, making all numeric arrays a constant value by '
+        'deleting their chunks and setting their fill values.')
+    parser.add_argument(
+        '--json',
+        help='Write the analysis of each array, including a histogram by '
+        'powers of two, to this path as JSON.  This implies --analyze.')
+    parser.add_argument(
+        '--workers', '-j', type=int,
+        help='The number of threads used to decompress and analyze chunks.  '
+        'Default is based on the number of CPUs.')
     opts = parser.parse_args()
     print(opts.source)
-    scan_zarr(opts.source, opts.analyze, opts.attrs, opts.sample, opts.empty)
+    scan_zarr(opts.source, opts.analyze, opts.attrs, opts.sample, opts.empty, opts.json,
+              opts.workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import tempfile
+import time
+
+import ttdump_to_tiff
+
+
+def synthetic_dump(path, ifdCount, tiles=64, maxValues=20):
+    """
+    Write a synthetic tifftools dump with many IFDs, each a tiled RGB image
+    with a few SubIFDs every so often.
+
+    :param path: the output path.
+    :param ifdCount: the number of top-level IFDs.
+    :param tiles: the number of tiles in each IFD.
+    :param maxValues: the maximum number of values listed for array tags, as
+        with the tifftools dump --max option.  0 lists all values.
+    """
+
+    def values(vals):
+        vals = list(vals)
+        text = ' '.join(str(v) for v in (vals[:maxValues] if maxValues else vals))
+        if maxValues and len(vals) > maxValues:
+            text += ' ...'
+        return f'<{len(vals)}> {text}' if len(vals) > 1 else text
+
+    def ifd_lines(indent, name, offset):
+        pre = '  ' * indent
+        lines = [
+            f'{pre}Directory {name}: offset {offset} (0x{offset:x})',
+            f'{pre}  ImageWidth 256 (0x100) LONG: {256 * 8}',
+            f'{pre}  ImageLength 257 (0x101) LONG: {256 * (tiles // 8)}',
+            f'{pre}  BitsPerSample 258 (0x102) SHORT: <3> 8 8 8',
+            f'{pre}  Compression 259 (0x103) SHORT: 7 (JPEG 7 (0x7))',
+            f'{pre}  Photometric 262 (0x106) SHORT: 6 (YCbCr 6 (0x6))',
+            f'{pre}  SamplesPerPixel 277 (0x115) SHORT: 3',
+            f'{pre}  XResolution 282 (0x11A) RATIONAL: 40000 1 (40000)',
+            f'{pre}  YResolution 283 (0x11B) RATIONAL: 40000 1 (40000)',
+            f'{pre}  PlanarConfig 284 (0x11C) SHORT: 1 (Chunky 1 (0x1))',
+            f'{pre}  ResolutionUnit 296 (0x128) SHORT: 3 (Centimeter 3 (0x3))',
+            f'{pre}  TileWidth 322 (0x142) LONG: 256',
+            f'{pre}  TileLength 323 (0x143) LONG: 256',
+            f'{pre}  TileOffsets 324 (0x144) LONG: ' + values(
+                range(offset, offset + tiles * 20000, 20000)),
+            f'{pre}  TileByteCounts 325 (0x145) LONG: ' + values(
+                19000 + (idx * 37) % 1000 for idx in range(tiles)),
+            f'{pre}  JPEGTables 347 (0x15B) UNDEFINED: <289> '
+            "b'\\xff\\xd8\\xff\\xdb\\x00C\\x00\\x08\\x06\\x06\\x07\\x06\\x05' ...",
+        ]
+        return lines
+
+    with open(path, 'w') as fptr:
+        fptr.write('-- synthetic.tif --\n')
+        fptr.write('Header: 0x4949 <little-endian> <BigTIFF>\n')
+        for idx in range(ifdCount):
+            offset = 16 + idx * tiles * 20000
+            lines = ifd_lines(0, idx, offset)
+            if not idx:
+                lines[1:1] = [
+                    '  ImageDescription 270 (0x10E) ASCII: Aperio Image Library v12',
+                    '46000x32914 [0,100 46000x32814] (256x256) JPEG/RGB Q=30',
+                    '|AppMag = 20|MPP = 0.499',
+                ]
+            if idx % 100 == 0:
+                lines.append('  SubIFD:0')
+                lines.extend(ifd_lines(2, f'{idx},SubIFD:0,0', offset + 1))
+            fptr.write('\n'.join(lines) + '\n')
+
+
+def benchmark(ifdCounts, maxValues, compression):
+    print('%8s %10s %10s %10s' % ('IFDs', 'dump MB', 'parse s', 'layout s'))
+    with tempfile.TemporaryDirectory() as tempdir:
+        for ifdCount in ifdCounts:
+            dumpPath = os.path.join(tempdir, 'dump.txt')
+            synthetic_dump(dumpPath, ifdCount, maxValues=maxValues)
+            start = time.time()
+            files = ttdump_to_tiff.parse_ttdump(dumpPath)
+            parseTime = time.time() - start
+            start = time.time()
+            ttdump_to_tiff.adjust_ifds(
+                files[0][0]['ifds'], None, [(8, None, False)], compression)
+            layoutTime = time.time() - start
+            print('%8d %10.1f %10.3f %10.3f' % (
+                ifdCount, os.path.getsize(dumpPath) / 1024 ** 2, parseTime, layoutTime))
+
+
+def command():
+    parser = argparse.ArgumentParser(
+        description='Time parsing and laying out synthetic tifftools dumps with '
+        'ttdump_to_tiff.')
+    parser.add_argument(
+        '--ifds', type=int, action='append',
+        help='The number of IFDs in a synthetic dump.  This may be specified '
+        'multiple times.  Default is 1000, 10000, and 100000.')
+    parser.add_argument(
+        '--max', type=int, default=20,
+        help='The maximum number of values listed for array tags, as with '
+        'tifftools dump --max.  0 lists all values.')
+    parser.add_argument(
+        '--compression', default='packbits', help='Output compression.')
+    opts = parser.parse_args()
+    benchmark(opts.ifds or [1000, 10000, 100000], opts.max, opts.compression)
+
+
+if __name__ == '__main__':
+    command()
@@ -2,26 +2,361 @@
 
 import argparse
 import ast
+import concurrent.futures
+import functools
 import json
 import math
+import mmap
+import os
 import pickle
 import re
+import struct
 import tempfile
 
 import tifftools
 
 
-def adjust_ifds(ifds, tmpfile, lenlist, compression):  # noqa
+class ZeroSource:
+    """
+    A read-only file-like object of a specific length that only contains
+    zeros.  This is used in place of a temporary file of image data when
+    writing sparse output.
+    """
+
+    blockSize = 1024 ** 2
+    zeroBlock = bytes(blockSize)
+
+    def __init__(self, size):
+        self.size = size
+        self.pos = 0
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.pos = offset + (
+            self.size if whence == os.SEEK_END else self.pos if whence == os.SEEK_CUR else 0)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, length=-1):
+        length = max(0, min(self.size - self.pos, self.size if length < 0 else length))
+        self.pos += length
+        return self.zeroBlock if length == self.blockSize else bytes(length)
+
+    def truncate(self, size=None):
+        self.size = self.pos if size is None else size
+        return self.size
+
+
+class SparseWriter:
+    """
+    Wrap a writable file so that blocks of zeros are skipped with a seek
+    rather than written, leaving holes in the file on filesystems that
+    support sparse files.
+    """
+
+    def __init__(self, fptr):
+        self.fptr = fptr
+        self.extent = fptr.seek(0, os.SEEK_END)
+        fptr.seek(0)
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            offset, whence = self.extent + offset, os.SEEK_SET
+        return self.fptr.seek(offset, whence)
+
+    def tell(self):
+        return self.fptr.tell()
+
+    def read(self, length=-1):
+        return self.fptr.read(length)
+
+    def write(self, data):
+        pos = self.fptr.tell()
+        if data is ZeroSource.zeroBlock or data.count(0) == len(data):
+            self.fptr.seek(len(data), os.SEEK_CUR)
+        else:
+            self.fptr.write(data)
+        self.extent = max(self.extent, pos + len(data))
+        return len(data)
+
+    def truncate(self, size=None):
+        size = self.fptr.tell() if size is None else size
+        self.extent = size
+        return self.fptr.truncate(size)
+
+    def close(self):
+        self.fptr.truncate(self.extent)
+        self.fptr.close()
+
+
+class Layout(list):
+    """
+    A list of (length, uncompressed length, only zero) entries describing the
+    synthetic image data of a file, as used by write_image_data.  The total
+    length is kept as entries are appended, so the offset of the next entry
+    doesn't have to be recomputed for each ifd.  An entry's uncompressed
+    length may instead be bytes of already encoded data.
+    """
+
+    def __init__(self, entries=()):
+        super().__init__()
+        self.offset = 0
+        self.dataOffsets = {}
+        self.extend(entries)
+
+    def add_data(self, data):
+        """
+        Add an entry of encoded data unless the same data has already been
+        added.
+
+        :param data: the encoded data.
+        :returns: the offset of the data.
+        """
+        if data not in self.dataOffsets:
+            self.dataOffsets[data] = self.offset
+            self.append((len(data), data, False))
+        return self.dataOffsets[data]
+
+    def append(self, entry):
+        super().append(entry)
+        self.offset += entry[0]
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+
+# Looking up tags in tifftools is comparatively slow, so do it once for the
+# tags used in laying out every ifd.
+LAYOUT_TAGS = {name: tifftools.Tag[name].value for name in {
+    'BitsPerSample', 'Compression', 'ImageLength', 'ImageWidth', 'RowsPerStrip',
+    'SampleFormat', 'Software', 'StripByteCounts', 'StripOffsets',
+    'TileByteCounts', 'TileLength', 'TileOffsets', 'TileWidth'}}
+
+
+@functools.lru_cache(maxsize=None)
+def is_other_bytecount(key):
+    """
+    Check if a tag is a byte count other than the strip or tile byte counts.
+
+    :param key: the numeric tag.
+    :returns: True if the tag is some other byte count.
+    """
+    return (key in tifftools.Tag and 'bytecount' in tifftools.Tag[key].name.lower() and
+            tifftools.Tag[key].name not in {'StripByteCounts', 'TileByteCounts'})
+
+
+# The number of distinct synthetic tiles encoded for each image shape.
+TILE_POOL_SIZE = 8
+# Compressions that libtiff applies the Predictor tag to
+PREDICTOR_COMPRESSIONS = {
+    tifftools.constants.Compression.LZW.value,
+    tifftools.constants.Compression.AdobeDeflate.value,
+    tifftools.constants.Compression.Deflate.value,
+    tifftools.constants.Compression.LZMA.value,
+    tifftools.constants.Compression.ZSTD.value,
+}
+
+
+def synthetic_tile(width, height, samples, dtype, index):
+    """
+    Generate tile content with smooth structure and noise so that encoded
+    sizes and decode costs resemble real images.
+
+    :param width: tile width.
+    :param height: tile height.
+    :param samples: the number of samples per pixel.
+    :param dtype: numpy dtype of the samples.
+    :param index: varies the content of the tile.
+    :returns: a numpy array.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(index)
+    y, x = np.mgrid[0:height, 0:width]
+    base = (np.sin((x + index * 37) / 23.0) + np.cos((y - index * 53) / 31.0)) * 48 + 128
+    tile = base[:, :, np.newaxis] + rng.normal(0, 12, (height, width, samples))
+    tile = np.clip(tile, 0, 255)
+    if dtype.kind == 'f':
+        tile = tile / 255
+    elif dtype.itemsize > 1:
+        tile = tile * (256 ** (dtype.itemsize - 1))
+    return tile.astype(dtype)
+
+
+@functools.lru_cache(maxsize=None)
+def encoded_tile_pool(codec, photometric, subsampling, width, height, samples, dtype,
+                      predictor=1):
+    """
+    Encode a pool of synthetic tiles.
+
+    :param codec: the numeric TIFF compression.
+    :param photometric: the numeric TIFF photometric interpretation.
+    :param subsampling: a tuple of the YCbCr subsampling.
+    :param width: tile width.
+    :param height: tile height.
+    :param samples: the number of samples per pixel.
+    :param dtype: numpy dtype of the samples.
+    :param predictor: the numeric TIFF predictor applied before encoding.
+        This is ignored for compressions that don't use a predictor.
+    :returns: a tuple of encoded tiles.
+    """
+    import imagecodecs
+
+    Compression = tifftools.constants.Compression
+    encoders = {
+        Compression['None'].value: lambda tile: tile.tobytes(),
+        Compression.LZW.value: imagecodecs.lzw_encode,
+        Compression.AdobeDeflate.value: imagecodecs.zlib_encode,
+        Compression.Deflate.value: imagecodecs.zlib_encode,
+        Compression.Packbits.value: imagecodecs.packbits_encode,
+        Compression.LZMA.value: imagecodecs.lzma_encode,
+        Compression.ZSTD.value: imagecodecs.zstd_encode,
+        Compression.WEBP.value: imagecodecs.webp_encode,
+        Compression.JXL.value: imagecodecs.jpegxl_encode,
+        Compression.JPEG.value: lambda tile: imagecodecs.jpeg8_encode(
+            tile, 90, colorspace='rgb' if samples == 3 else None,
+            outcolorspace=(
+                'ycbcr' if photometric == tifftools.constants.Photometric.YCbCr.value else
+                'rgb' if samples == 3 else None),
+            subsampling=subsampling if samples == 3 else None),
+    }
+    for codecName in {'JP2kYCbCr', 'JP2kRGB', 'JP2000'}:
+        encoders[Compression[codecName].value] = (
+            lambda tile, mct=codecName == 'JP2kYCbCr': imagecodecs.jpeg2k_encode(
+                tile, 80, codecformat=imagecodecs.JPEG2K.CODEC.J2K, mct=mct))
+    if codec not in encoders:
+        msg = 'Cannot encode with compression %s' % codec
+        raise Exception(msg)
+    predictors = {
+        1: lambda tile: tile,
+        2: lambda tile: imagecodecs.delta_encode(tile, axis=1),
+        3: lambda tile: imagecodecs.floatpred_encode(tile, axis=1),
+    }
+    if codec not in PREDICTOR_COMPRESSIONS:
+        predictor = 1
+    if predictor not in predictors:
+        msg = 'Cannot encode with predictor %s' % predictor
+        raise Exception(msg)
+    if samples == 1:
+        encoder = encoders[codec]
+        encoders[codec] = lambda tile: encoder(tile[:, :, 0])
+    return tuple(
+        bytes(encoders[codec](predictors[predictor](
+            synthetic_tile(width, height, samples, dtype, index))))
+        for index in range(TILE_POOL_SIZE))
+
+
+def encode_tiles(tags, off, counts, w, h, h2, lenlist, ifdName):
+    """
+    Point the strips or tiles of an ifd at a small pool of synthetic tiles
+    encoded with the ifd's original compression, predictor, and photometric
+    interpretation.
+
+    :param tags: the ifd's tags.
+    :param off: the strip or tile offsets tag record.
+    :param counts: the strip or tile byte counts tag record.
+    :param w: strip or tile width.
+    :param h: strip or tile height.
+    :param h2: the height of the last strip.
+    :param lenlist: the Layout to add the encoded tiles to.
+    :param ifdName: a description of the ifd for error messages.
+    """
+    import numpy as np
+
+    Tag = tifftools.Tag
+    codec = tags[Tag.Compression.value]['data'][0] if Tag.Compression.value in tags else 1
+    samples = (tags[Tag.SamplesPerPixel.value]['data'][0]
+               if Tag.SamplesPerPixel.value in tags else 1)
+    if Tag.PlanarConfig.value in tags and tags[Tag.PlanarConfig.value]['data'][0] == 2:
+        samples = 1
+    photometric = (tags[Tag.Photometric.value]['data'][0] if Tag.Photometric.value in tags
+                   else 2 if samples == 3 else 1)
+    subsampling = (tuple(tags[Tag.YCbCrSubsampling.value]['data'])
+                   if Tag.YCbCrSubsampling.value in tags else (2, 2))
+    sampleFormat = (tags[Tag.SampleFormat.value]['data'][0]
+                    if Tag.SampleFormat.value in tags else 1)
+    predictor = tags[Tag.Predictor.value]['data'][0] if Tag.Predictor.value in tags else 1
+    try:
+        dtype = np.dtype('%s%d' % (
+            {1: 'u', 2: 'i', 3: 'f'}[sampleFormat],
+            tags[Tag.BitsPerSample.value]['data'][0] // 8))
+        pool = encoded_tile_pool(
+            codec, photometric, subsampling, w, h, samples, dtype, predictor)
+        lastPool = pool if h2 == h or not h2 else encoded_tile_pool(
+            codec, photometric, subsampling, w, h2, samples, dtype, predictor)
+    except Exception as exc:
+        msg = 'Cannot encode synthetic tiles for %s with compression %s: %s' % (
+            ifdName, codec, exc)
+        raise Exception(msg)
+    offsets = [lenlist.add_data(data) for data in pool]
+    off['data'] = [offsets[idx % len(pool)] for idx in range(len(off['data']))]
+    counts['data'] = [len(pool[idx % len(pool)]) for idx in range(len(off['data']))]
+    if lastPool is not pool:
+        off['data'][-1] = lenlist.add_data(lastPool[0])
+        counts['data'][-1] = len(lastPool[0])
+    # Each tile is a complete JPEG, so tables from the source don't apply
+    tags.pop(Tag.JPEGTables.value, None)
+    if Tag.Predictor.value in tags and codec not in PREDICTOR_COMPRESSIONS:
+        tags[Tag.Predictor.value]['data'][0] = 1
+    if (photometric == tifftools.constants.Photometric.YCbCr.value and
+            codec != tifftools.constants.Compression.JPEG.value):
+        tags[Tag.Photometric.value]['data'][0] = tifftools.constants.Photometric.RGB.value
+
+
+def filled_like(data, value):
+    """
+    Make a list or array of the same length as some tag data with every
+    entry set to one value.  Arrays from binary dumps stay arrays.
+
+    :param data: a list or numpy array.
+    :param value: the value to fill.
+    :returns: a list or numpy array.
+    """
+    if isinstance(data, list):
+        return [value] * len(data)
+    import numpy as np
+
+    return np.full(len(data), value, dtype=np.uint64)
+
+
+def adjust_ifds(ifds, tmpfile, lenlist, compression, name='ifd '):  # noqa
+    """
+    Set the strip or tile offsets and byte counts of ifds to refer to
+    synthetic image data and record the data that needs to be generated.
+
+    :param ifds: a list of ifds to modify.
+    :param tmpfile: the file that will contain the synthetic data.
+    :param lenlist: a Layout or a list of (length, uncompressed length, only
+        zero) entries of data that precedes these ifds' data.
+    :param compression: the output compression.  If 'original', strips and
+        tiles are encoded with each ifd's compression.
+    :param name: the prefix of the names of the ifds in error messages.
+    :returns: a Layout including the entries for these ifds.
+    """
+    if not isinstance(lenlist, Layout):
+        lenlist = Layout(lenlist)
+    tagnum = LAYOUT_TAGS
+    compressionNone = tifftools.constants.Compression['None'].value
+    compressionPackbits = tifftools.constants.Compression.Packbits.value
     anySamplesFloat = False
-    for ifd in ifds:
+    for ifdidx, ifd in enumerate(ifds):
+        tags = ifd['tags']
         maxlen = 0
         uncomplen = None
-        for key, record in ifd['tags'].items():
+        for key, record in tags.items():
             if 'ifds' in record:
-                for ifdlist in record['ifds']:
-                    adjust_ifds(ifdlist, tmpfile, lenlist, compression)
-            if (key in tifftools.Tag and 'bytecount' in tifftools.Tag[key].name.lower() and
-                    tifftools.Tag[key].name not in {'StripByteCounts', 'TileByteCounts'}):
+                for subidx, ifdlist in enumerate(record['ifds']):
+                    adjust_ifds(ifdlist, tmpfile, lenlist, compression,
+                                '%s%d subifd %d:' % (name, ifdidx, subidx))
+            if is_other_bytecount(key):
                 maxlen = max(maxlen, max(record['data']))
         off = None
         counts = None
@@ -29,43 +364,50 @@ def adjust_ifds(ifds, tmpfile, lenlist, compression):  # noqa
         if maxlen:
             lenlist.append((maxlen, None, anySamplesFloat))
             maxlen = 0
-        if tifftools.Tag.StripOffsets.value in ifd['tags']:
-            off = ifd['tags'][tifftools.Tag.StripOffsets.value]
-            counts = ifd['tags'][tifftools.Tag.StripByteCounts.value]
-            w = ifd['tags'][tifftools.Tag.ImageWidth.value]['data'][0]
-            h = ifd['tags'][tifftools.Tag.RowsPerStrip.value]['data'][0]
-            h2 = ifd['tags'][tifftools.Tag.ImageLength.value]['data'][0] - (
-                ifd['tags'][tifftools.Tag.ImageLength.value]['data'][0] // h) * h or h
-        if tifftools.Tag.TileOffsets.value in ifd['tags']:
-            off = ifd['tags'][tifftools.Tag.TileOffsets.value]
-            counts = ifd['tags'][tifftools.Tag.TileByteCounts.value]
-            w = ifd['tags'][tifftools.Tag.TileWidth.value]['data'][0]
-            h = ifd['tags'][tifftools.Tag.TileLength.value]['data'][0]
+        if tagnum['StripOffsets'] in tags:
+            off = tags[tagnum['StripOffsets']]
+            counts = tags[tagnum['StripByteCounts']]
+            w = tags[tagnum['ImageWidth']]['data'][0]
+            # RowsPerStrip defaults to 2**32 - 1 and may exceed the image
+            # length when there is a single strip
+            h = min(tags[tagnum['RowsPerStrip']]['data'][0]
+                    if tagnum['RowsPerStrip'] in tags else 2 ** 32 - 1,
+                    tags[tagnum['ImageLength']]['data'][0])
+            h2 = tags[tagnum['ImageLength']]['data'][0] - (
+                tags[tagnum['ImageLength']]['data'][0] // h) * h or h
+        if tagnum['TileOffsets'] in tags:
+            off = tags[tagnum['TileOffsets']]
+            counts = tags[tagnum['TileByteCounts']]
+            w = tags[tagnum['TileWidth']]['data'][0]
+            h = tags[tagnum['TileLength']]['data'][0]
             h2 = h
+        if off and compression == 'original':
+            encode_tiles(tags, off, counts, w, h, h2, lenlist, '%s%d' % (name, ifdidx))
+            ifd['path_or_fobj'] = tmpfile
+            ifd['size'] = lenlist.offset
+            continue
         if off:
-            bps = sum(ifd['tags'][tifftools.Tag.BitsPerSample.value]['data'])
-            if tifftools.Tag.SampleFormat.value in ifd['tags']:
+            bps = sum(tags[tagnum['BitsPerSample']]['data'])
+            if tagnum['SampleFormat'] in tags:
                 anySamplesFloat = anySamplesFloat or (
-                    ifd['tags'][tifftools.Tag.SampleFormat.value]['data'][0] not in {1, 2})
-            elif (tifftools.Tag.Software.value in ifd['tags'] and
-                    'IndicaLabs' in ifd['tags'][tifftools.Tag.Software.value]['data']):
+                    tags[tagnum['SampleFormat']]['data'][0] not in {1, 2})
+            elif (tagnum['Software'] in tags and
+                    'IndicaLabs' in tags[tagnum['Software']]['data']):
                 anySamplesFloat = True
-            if tifftools.Tag.Compression.value not in ifd['tags']:
-                ifd['tags'][tifftools.Tag.Compression.value] = {
+            if tagnum['Compression'] not in tags:
+                tags[tagnum['Compression']] = {
                     'datatype': tifftools.Datatype.SHORT,
                     'count': 1,
                     'data': [0],
                 }
-            ifd['tags'][tifftools.Tag.Compression.value]['data'][0] = \
-                tifftools.constants.Compression['None'].value
+            tags[tagnum['Compression']]['data'][0] = compressionNone
             bytesperchunk = int(math.ceil(w * bps / 8)) * h
             if compression == 'packbits':
-                ifd['tags'][tifftools.Tag.Compression.value]['data'][0] = \
-                    tifftools.constants.Compression.Packbits.value
+                tags[tagnum['Compression']]['data'][0] = compressionPackbits
                 uncomplen = bytesperchunk
                 bytesperchunk = (uncomplen + 127) // 128 * 2
-            counts['data'] = [bytesperchunk] * len(counts['data'])
-            off['data'] = [sum(v[0] for v in lenlist)] * len(off['data'])
+            counts['data'] = filled_like(counts['data'], bytesperchunk)
+            off['data'] = filled_like(off['data'], lenlist.offset)
             maxlen = max(maxlen, bytesperchunk)
             if h2 and h2 != h:
                 if len(off['data']) > 1:
@@ -77,14 +419,17 @@ def adjust_ifds(ifds, tmpfile, lenlist, compression):  # noqa
                     bytesperchunk = (uncomplen + 127) // 128 * 2
                 maxlen = max(maxlen, bytesperchunk)
                 counts['data'][-1] = bytesperchunk
-                off['data'][-1] = sum(v[0] for v in lenlist)
+                off['data'][-1] = lenlist.offset
         ifd['path_or_fobj'] = tmpfile
-        ifd['size'] = sum(v[0] for v in lenlist) + maxlen
+        ifd['size'] = lenlist.offset + maxlen
         if maxlen:
             lenlist.append((maxlen, uncomplen, anySamplesFloat))
     return lenlist
 
 
+MCU_RESTART = re.compile(rb'\xff[\xd0-\xd7]')
+
+
 def set_mcu_starts(path, mcutag, offset, length):
     """
     Find the MCU restart locations and populate tag data with the information.
@@ -95,79 +440,108 @@ def set_mcu_starts(path, mcutag, offset, length):
     :param offset: start of the JPEG in the file.
     :param length: length of the JPEG in the file.
     """
-    fptr = open(path, 'rb')
-    fptr.seek(offset)
-    chunksize = 2 * 1024 ** 2
     mcu = []
-    previous = b''
-    pos = 0
-    while length > 0:
-        data = fptr.read(min(length, chunksize))
-        if len(data) != min(length, chunksize):
-            length = 0
-        else:
-            length -= len(data)
-        data = previous + data
-        parts = data.split(b'\xff')
-        previous = b'\xff' + parts[-1]
-        pos += len(parts[0])
-        for part in parts[1:-1]:
-            if len(part):
-                if not len(mcu):
-                    if part[0] == 0xda:
-                        mcu.append(pos + 2 + part[1] * 256 + part[2])
-                elif part[0] >= 0xd0 and part[0] <= 0xd7:
-                    mcu.append(pos + 2)
-            pos += 1 + len(part)
+    with open(path, 'rb') as fptr, mmap.mmap(
+            fptr.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        end = min(offset + length, len(data))
+        sos = data.find(b'\xff\xda', offset, end)
+        if sos >= 0 and sos + 4 <= end:
+            mcu.append(sos - offset + 2 + data[sos + 2] * 256 + data[sos + 3])
+            mcu.extend(match.start() - offset + 2
+                       for match in MCU_RESTART.finditer(data, sos + 2, end))
     mcutag['data'] = mcu
 
 
-def convert_to_ndpi(destName):
-    import os
+def encode_ndpi_ifd(destName, idx, restartInterval, jpegPath, findMcu):
+    """
+    Encode one page of a file as a JPEG with restart markers, as needed for
+    an NDPI file.
+
+    :param destName: the path of the file.
+    :param idx: the page to encode.
+    :param restartInterval: the number of MCUs between restart markers.
+    :param jpegPath: the path to write the JPEG.
+    :param findMcu: if True, find the MCU starts of the JPEG.
+    :returns: a list of MCU starts relative to the start of the JPEG, or None.
+    """
     import shutil
     import subprocess
 
     import pyvips
 
+    img = pyvips.Image.tiffload(destName, page=idx)
+    if shutil.which('jpegtran'):
+        img.jpegsave(jpegPath + '.tmp', Q=91, subsample_mode=pyvips.ForeignSubsample.OFF)
+        with open(jpegPath, 'wb') as fptr:
+            subprocess.check_call(
+                ['jpegtran', '-optimize', '-restart', '%dB' % restartInterval,
+                 jpegPath + '.tmp'], stdout=fptr)
+        os.unlink(jpegPath + '.tmp')
+    else:
+        img.jpegsave(
+            jpegPath, Q=91, subsample_mode=pyvips.ForeignSubsample.OFF,
+            optimize_coding=True, restart_interval=restartInterval)
+    if findMcu:
+        mcutag = {}
+        set_mcu_starts(jpegPath, mcutag, 0, os.path.getsize(jpegPath))
+        return mcutag['data']
+
+
+def convert_to_ndpi(destName, workers=None):
+    """
+    Convert a tiff file to an NDPI file by recompressing each ifd as a single
+    JPEG with restart markers.  The JPEGs are encoded in a process pool and
+    appended to the file in order.
+
+    :param destName: the path of the file to convert in place.
+    :param workers: the number of processes to use.  None uses the number of
+        CPUs.
+    """
+    import shutil
+
     with tempfile.TemporaryDirectory() as tempdir:
         info = tifftools.read_tiff(destName)
         info['ndpi'] = True
-        for idx, ifd in enumerate(info['ifds']):
-            ifdw = ifd['tags'][tifftools.Tag.ImageWidth.value]['data'][0]
-            ifdh = ifd['tags'][tifftools.Tag.ImageLength.value]['data'][0]
-            ifdsamp = ifd['tags'][tifftools.Tag.SamplesPerPixel.value]['data'][0]
-            jpegPath = os.path.join(tempdir, '_wsi_%d.jpeg' % idx)
-            jpegPos = os.path.getsize(destName)
-            img = pyvips.Image.tiffload(destName, page=idx)
-            img.jpegsave(jpegPath, Q=91, subsample_mode=pyvips.ForeignSubsample.OFF)
-            if tifftools.Tag.NDPI_MCU_STARTS.value in ifd['tags']:
-                restartInterval = (
-                    int(math.ceil(ifdw / 8) * math.ceil(ifdh / 8)) //
-                    len(ifd['tags'][tifftools.Tag.NDPI_MCU_STARTS.value]['data']))
-            else:
-                restartInterval = 1024
-            subprocess.check_call(
-                ['jpegtran', '-optimize', '-restart', '%dB' % restartInterval, jpegPath],
-                stdout=open(destName, 'ab'))
-            jpegLen = os.path.getsize(destName) - jpegPos
-            ifd['tags'][tifftools.Tag.Compression.value]['data'][0] = \
-                tifftools.constants.Compression.JPEG.value
-            # The 1-bit per image is labelled as RGB
-            ifd['tags'][tifftools.Tag.Photometric.value]['data'][0] = (
-                tifftools.constants.Photometric.YCbCr.value if ifdsamp == 3 else
-                # tifftools.constants.Photometric.MinIsBlack.value)
-                tifftools.constants.Photometric.RGB.value)
-            ifd['tags'][tifftools.Tag.StripOffsets.value]['data'] = [jpegPos]
-            ifd['tags'][tifftools.Tag.StripByteCounts.value]['data'] = [jpegLen]
-            if tifftools.Tag.NDPI_MCU_STARTS.value in ifd['tags']:
-                set_mcu_starts(
-                    destName, ifd['tags'][tifftools.Tag.NDPI_MCU_STARTS.value],
-                    ifd['tags'][tifftools.Tag.StripOffsets.value]['data'][0],
-                    sum(ifd['tags'][tifftools.Tag.StripByteCounts.value]['data']))
-            if tifftools.Tag.NDPI_PROPERTY_MAP.value in ifd['tags']:
-                ifd['tags'][tifftools.Tag.NDPI_PROPERTY_MAP.value]['data'] = \
-                    ifd['tags'][tifftools.Tag.NDPI_PROPERTY_MAP.value]['data'].strip().replace(
-                        '\n', '\r\n') + '\r\n'
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = []
+            for idx, ifd in enumerate(info['ifds']):
+                ifdw = ifd['tags'][tifftools.Tag.ImageWidth.value]['data'][0]
+                ifdh = ifd['tags'][tifftools.Tag.ImageLength.value]['data'][0]
+                if tifftools.Tag.NDPI_MCU_STARTS.value in ifd['tags']:
+                    restartInterval = (
+                        int(math.ceil(ifdw / 8) * math.ceil(ifdh / 8)) //
+                        len(ifd['tags'][tifftools.Tag.NDPI_MCU_STARTS.value]['data']))
+                else:
+                    restartInterval = 1024
+                futures.append(executor.submit(
+                    encode_ndpi_ifd, destName, idx, restartInterval,
+                    os.path.join(tempdir, '_wsi_%d.jpeg' % idx),
+                    tifftools.Tag.NDPI_MCU_STARTS.value in ifd['tags']))
+            with open(destName, 'ab') as dest:
+                for idx, ifd in enumerate(info['ifds']):
+                    mcu = futures[idx].result()
+                    jpegPath = os.path.join(tempdir, '_wsi_%d.jpeg' % idx)
+                    jpegPos = dest.tell()
+                    with open(jpegPath, 'rb') as fptr:
+                        shutil.copyfileobj(fptr, dest)
+                    jpegLen = dest.tell() - jpegPos
+                    os.unlink(jpegPath)
+                    ifdsamp = ifd['tags'][tifftools.Tag.SamplesPerPixel.value]['data'][0]
+                    ifd['tags'][tifftools.Tag.Compression.value]['data'][0] = \
+                        tifftools.constants.Compression.JPEG.value
+                    # The 1-bit per image is labelled as RGB
+                    ifd['tags'][tifftools.Tag.Photometric.value]['data'][0] = (
+                        tifftools.constants.Photometric.YCbCr.value if ifdsamp == 3 else
+                        # tifftools.constants.Photometric.MinIsBlack.value)
+                        tifftools.constants.Photometric.RGB.value)
+                    ifd['tags'][tifftools.Tag.StripOffsets.value]['data'] = [jpegPos]
+                    ifd['tags'][tifftools.Tag.StripByteCounts.value]['data'] = [jpegLen]
+                    if mcu is not None:
+                        ifd['tags'][tifftools.Tag.NDPI_MCU_STARTS.value]['data'] = mcu
+                    if tifftools.Tag.NDPI_PROPERTY_MAP.value in ifd['tags']:
+                        ifd['tags'][tifftools.Tag.NDPI_PROPERTY_MAP.value]['data'] = \
+                            ifd['tags'][tifftools.Tag.NDPI_PROPERTY_MAP.value][
+                                'data'].strip().replace('\n', '\r\n') + '\r\n'
         info['size'] = os.path.getsize(destName)
         for ifd in info['ifds']:
             ifd['size'] = info['size']
@@ -175,43 +549,76 @@ def convert_to_ndpi(destName):
         shutil.move(destName + '.ndpi', destName)
 
 
-def write(info, name, destName, compression):
+def write_image_data(tmpfile, lenlist, sparse=False):
+    """
+    Fill a temporary file with synthetic image data.  Each entry gets a
+    different byte value so that distinct images are distinguishable.
+
+    :param tmpfile: the file to write to.
+    :param lenlist: a list of (length, uncompressed length, only zero) tuples
+        as generated by adjust_ifds.  If uncompressed length is not None, the
+        data is packbits compressed.  If it is bytes, it is the data.
+    :param sparse: if True, all data is zero.
+    """
+    for idx, [count, uncompcount, onlyZero] in enumerate(lenlist):
+        if isinstance(uncompcount, bytes):
+            tmpfile.write(uncompcount)
+            continue
+        val = idx
+        if idx:
+            rem = 256 - idx
+            val = 0
+            while rem:
+                val *= 2
+                if rem & 1:
+                    val += 1
+                rem >>= 1
+        if onlyZero or sparse:
+            val = 0
+        val = val.to_bytes(1, 'little')
+        chunk = 65536
+        if not uncompcount:
+            for pos in range(0, count, chunk):
+                tmpfile.write(val * min(chunk, count - pos))
+        else:
+            for pos in range(0, uncompcount, chunk * 128):
+                chunklen = min(chunk * 128, uncompcount - pos)
+                rle = (b'\x81' + val) * (chunklen // 128)
+                if chunklen - (chunklen // 128) * 128:
+                    rle += (257 - (chunklen - (chunklen // 128) * 128)).to_bytes(
+                        1, 'little') + val
+                tmpfile.write(rle)
+
+
+def write(info, name, destName, compression, sparse=False):
     # For stripbytecounts and tilebytecounts, set compression to none and
     # recalculate size based on strip or tile size
     with tempfile.TemporaryFile() as tmpfile:
-        lenlist = adjust_ifds(info['ifds'], tmpfile, [(8, None, False)], compression)
-        for idx, [count, uncompcount, onlyZero] in enumerate(lenlist):
-            val = idx
-            if idx:
-                rem = 256 - idx
-                val = 0
-                while rem:
-                    val *= 2
-                    if rem & 1:
-                        val += 1
-                    rem >>= 1
-            if onlyZero:
-                val = 0
-            val = val.to_bytes(1, 'little')
-            chunk = 65536
-            if not uncompcount:
-                for pos in range(0, count, chunk):
-                    tmpfile.write(val * min(chunk, count - pos))
-            else:
-                for pos in range(0, uncompcount, chunk * 128):
-                    chunklen = min(chunk * 128, uncompcount - pos)
-                    rle = (b'\x81' + val) * (chunklen // 128)
-                    if chunklen - (chunklen // 128) * 128:
-                        rle += (257 - (chunklen - (chunklen // 128) * 128)).to_bytes(
-                            1, 'little') + val
-                    tmpfile.write(rle)
+        if sparse and compression == 'none':
+            # All of the uncompressed data is zero, so we don't need to
+            # generate it
+            source = ZeroSource(0)
+            lenlist = adjust_ifds(info['ifds'], source, [(8, None, False)], compression)
+            source.truncate(lenlist.offset)
+        else:
+            lenlist = adjust_ifds(info['ifds'], tmpfile, [(8, None, False)], compression)
+            write_image_data(tmpfile, lenlist, sparse)
         print('%s -> %s' % (name or '', destName))
-        tifftools.write_tiff(info, destName, allowExisting=True, dedup=True, ifdsFirst=True)
+        if sparse:
+            # Deduplication would hash all of the zeros; duplicate zeros take
+            # no disk space in a sparse file, so skip it
+            dest = SparseWriter(open(destName, 'w+b'))
+            try:
+                tifftools.write_tiff(info, dest, dedup=False, ifdsFirst=True)
+            finally:
+                dest.close()
+        else:
+            tifftools.write_tiff(info, destName, allowExisting=True, dedup=True, ifdsFirst=True)
     if destName.endswith('.ndpi'):
         convert_to_ndpi(destName)
 
 
-def generate_imagej_if_needed(info, destName, compression):
+def generate_imagej_if_needed(info, destName, compression, sparse=False):
     if compression == 'none' and len(info['ifds']) == 1:
         try:
             desc = info['ifds'][0]['tags'][tifftools.Tag.ImageDescription.value]['data']
@@ -224,166 +631,422 @@ def generate_imagej_if_needed(info, destName, compression):
                     count = framelen * (int(ijdict['images']) - 1)
                     chunk = 65536
                     with open(destName, 'ab') as fptr:
+                        if sparse:
+                            fptr.truncate(fptr.seek(0, os.SEEK_END) + count)
+                            return
                         for pos in range(0, count, chunk):
                             fptr.write(b'\x00' * min(chunk, count - pos))
         except Exception:
             pass
 
 
-def parse_ttdump(sourceName, destName, compression):  # noqa
+TTDUMP_DIRECTORY = re.compile(r'^ *Directory ([0-9]+)[,:].*$')
+TTDUMP_SUBIFD = re.compile(r'^ *([0-9a-zA-Z]+):([0-9]+)$')
+TTDUMP_TAG = re.compile(
+    r'^ *(?:[^ ]+ |)([0-9]+) \(0x[0-9A-F]+\) ([A-Z]+[A-Z0-9]*): (?:<([0-9]+)> |)(.*)$')
+TTDUMP_GEOTAG = re.compile(r'^ *([A-Za-z]+): (.*)$')
+
+
+@functools.lru_cache(maxsize=None)
+def tag_info(tagnum):
+    """
+    Look up a tag number from a dump line.  The tifftools constant lookups are
+    comparatively slow and the same few tags appear on most lines.
+
+    :param tagnum: the tag number as a string.
+    :returns: the numeric tag and whether the tag holds offsets to data.
+    """
+    try:
+        key = tifftools.Tag[tagnum].value
+    except KeyError:
+        key = int(tagnum)
+    return key, tagnum in tifftools.Tag and tifftools.Tag[tagnum].isOffsetData()
+
+
+@functools.lru_cache(maxsize=None)
+def datatype_value(name):
+    return tifftools.Datatype[name].value
+
+
+def parse_tag(tagnum, dtype, count, val):
+    """
+    Convert the parts of a tag line from a dump to a tag record.
+
+    :param tagnum: the tag number as a string.
+    :param dtype: the datatype name.
+    :param count: the count as a string or None for a single value.
+    :param val: the listed data.
+    :returns: the numeric tag and the record.
+    """
+    key, isOffsetData = tag_info(tagnum)
+    record = {
+        'datatype': datatype_value(dtype),
+        'count': int(count) if count else 1,
+    }
+    if dtype == 'ASCII':
+        record['data'] = val
+    elif dtype in {'BYTE', 'UNDEFINED'}:
+        if "' ..." in val:
+            val = val.rsplit("' ...")[0] + "'"
+        if val[:1] == "'":
+            record['data'] = ast.literal_eval(val)
+        elif val[:2] == "b'":
+            record['data'] = ast.literal_eval(val)
+        else:
+            record['data'] = [int(v) for v in val.split(' ') if v != '...']
+    else:
+        count = record['count'] * (2 if 'RATIONAL' in dtype else 1)
+        if isOffsetData:
+            # The offsets are rewritten when the file is laid out, so don't
+            # bother parsing what may be a very long list of values.
+            record['data'] = [8] * count
+            return key, record
+        conv = float if dtype in {'FLOAT', 'DOUBLE'} else int
+        data = [conv(v) for v in val.split(None, count)[:count]
+                if '(' not in v and '...' not in v]
+        while len(data) and len(data) < count:
+            data += data
+        record['data'] = data[:count]
+    return key, record
+
+
+def add_geotag(ifd, geokey, val):
+    """
+    Add a GeoTIFF key from a dump to the GeoKeyDirectoryTag and the associated
+    parameter tags of an ifd.
+
+    :param ifd: the ifd to modify.
+    :param geokey: the name of the geokey.
+    :param val: the listed value of the geokey.
+    :returns: False if the geokey is not recognized.
+    """
+    if 'geotag' not in ifd:
+        ifd['geotag'] = [[1, 1, 1, 0], [], '']
+    try:
+        taginfo = tifftools.constants.GeoTiffGeoKey[geokey]
+    except Exception:
+        ifd.pop('geotag', None)
+        return False
+    key = taginfo.value
+    if taginfo['datatype'] == tifftools.Datatype.DOUBLE:
+        ttype = tifftools.Tag.GeoDoubleParamsTag.value
+        val = [float(v) for v in val.split()]
+        if (len(val) == 1 and int(val[0]) == val[0] and
+                val[0] >= -32768 and val[0] <= 32767):
+            ttype, count, offset = 0, 1, int(val[0])
+        else:
+            count = len(val)
+            offset = len(ifd['geotag'][1])
+            ifd['geotag'][1].extend(val)
+    elif taginfo['datatype'] == tifftools.Datatype.ASCII:
+        ttype = tifftools.Tag.GeoASCIIParamsTag.value
+        val = val + '|'
+        count = len(val)
+        offset = len(ifd['geotag'][2])
+        ifd['geotag'][2] += val
+    else:
+        ttype = 0
+        count = 1
+        offset = int(val)
+    ifd['geotag'][0].extend([key, ttype, count, offset])
+    ifd['geotag'][0][3] += 1
+    ifd['tags'][tifftools.Tag.GeoKeyDirectoryTag.value] = {
+        'datatype': tifftools.Datatype.SHORT,
+        'count': len(ifd['geotag'][0]),
+        'data': ifd['geotag'][0]
+    }
+    if len(ifd['geotag'][1]):
+        ifd['tags'][tifftools.Tag.GeoDoubleParamsTag.value] = {
+            'datatype': tifftools.Datatype.DOUBLE,
+            'count': len(ifd['geotag'][1]),
+            'data': ifd['geotag'][1]
+        }
+    if len(ifd['geotag'][2]):
+        ifd['tags'][tifftools.Tag.GeoASCIIParamsTag.value] = {
+            'datatype': tifftools.Datatype.ASCII,
+            'data': ifd['geotag'][2]
+        }
+    return True
+
+
+def parse_ttdump(sourceName):  # noqa
+    """
+    Parse a tifftools dump.  The file is read a line at a time, so very large
+    dumps don't need to be held in memory.  Tag lines are by far the most
+    common, so they are checked first and other patterns are only tried on
+    lines that could match them.
+
+    :param sourceName: the path of the dump.
+    :returns: a list with a tuple of the parsed info and the name of the file
+        listed in the dump (or None) for each file in the dump.
+    """
+    files = []
     info = {}
     isgeo = False
     currentName = None
     lastascii = None
-    for line in open(sourceName).readlines():
-        line = line.rstrip()
-        if line.startswith('-- ') and line.endswith(' --'):
-            currentName = line.split('-- ', 1)[1].rsplit(' --', 1)[0]
-            continue
-        if line.startswith('Header: '):
-            if len(info):
-                write(info, currentName, destName, compression)
-                raise Exception('Update destName')
-            info = {}
-            info['bigEndian'] = 'big-endian' in line
-            info['bigtiff'] = 'BigTIFF' in line
-            ifd = None
-            info['ifds'] = []
-            ifdlist = []
-            continue
-        tdir = re.match(r'^ *Directory ([0-9]+)[,:].*$', line)
-        subifd = re.match(r'^ *([0-9a-zA-Z]+):([0-9]+)$', line)
-        tag = re.match(
-            r'^ *(([^ ]+) |)([0-9]+) \(0x([0-9A-F]+)\) ([A-Z]+[A-Z0-9]*): (<([0-9]+)> |)(.*)$',
-            line)
-        geotag = re.match(r'^ *([A-Za-z]+): (.*)$', line) if isgeo else None
-        if not tag and not subifd and not tdir and not geotag:
-            if lastascii:
-                lastascii['data'] += '\n' + line
-            continue
-        lastascii = None
-        while not line.startswith('  ' * len(ifdlist)) and len(ifdlist):
-            ifdlist = ifdlist[:-1]
-        if tdir:
-            if not len(ifdlist):
-                info['ifds'].append({'tags': {}})
-                ifd = info['ifds'][-1]
-            else:
-                ifdlist[-1].append({'tags': {}})
-                ifd = ifdlist[-1][-1]
-            ifdlist.append(ifd)
-            continue
-        if subifd:
-            newifd = []
-            if tifftools.Tag[subifd.groups()[0]].value not in ifd['tags']:
-                ifd['tags'][tifftools.Tag[subifd.groups()[0]].value] = {'ifds': []}
-            ifd['tags'][tifftools.Tag[subifd.groups()[0]].value]['ifds'].append(newifd)
-            ifd = None
-            ifdlist.append(newifd)
-            continue
-        if tag:
-            try:
-                key = tifftools.Tag[tag.groups()[2]].value
-            except KeyError:
-                key = int(tag.groups()[2])
-            record = {
-                'datatype': tifftools.Datatype[tag.groups()[4]].value,
-                'count': int(tag.groups()[6]) if tag.groups()[6] else 1,
-            }
-            if tag.groups()[4] == 'ASCII':
-                record['data'] = tag.groups()[7]
-                lastascii = record
-            elif tag.groups()[4] in {'BYTE', 'UNDEFINED'}:
-                val = tag.groups()[7]
-                if "' ..." in val:
-                    val = val.rsplit("' ...")[0] + "'"
-                if val[:1] == "'":
-                    record['data'] = ast.literal_eval(val)
-                elif val[:2] == "b'":
-                    record['data'] = ast.literal_eval(val)
-                else:
-                    record['data'] = [int(v) for v in val.split(' ') if v != '...']
-            else:
-                count = record['count'] * (2 if 'RATIONAL' in tag.groups()[4] else 1)
-                data = [float(v) if tag.groups()[4] in {'FLOAT', 'DOUBLE'} else int(v)
-                        for v in tag.groups()[7].split()[:count]
-                        if '(' not in v and '...' not in v]
-                while len(data) and len(data) < count:
-                    data += data
-                data = data[:count]
-                if (tag.groups()[2] in tifftools.Tag and
-                        tifftools.Tag[tag.groups()[2]].isOffsetData()):
-                    data = [8] * count
-                record['data'] = data
-            isgeo = key == tifftools.Tag.GeoKeyDirectoryTag.value
-            if 'geotag' in ifd and key in {
-                    tifftools.Tag.GeoDoubleParamsTag.value,
-                    tifftools.Tag.GeoASCIIParamsTag.value}:
+    geoParamTags = {
+        tifftools.Tag.GeoDoubleParamsTag.value,
+        tifftools.Tag.GeoASCIIParamsTag.value}
+    geoDirectoryTag = tifftools.Tag.GeoKeyDirectoryTag.value
+    with open(sourceName) as fptr:
+        for line in fptr:
+            line = line.rstrip()
+            if line.startswith('-- ') and line.endswith(' --'):
+                currentName = line.split('-- ', 1)[1].rsplit(' --', 1)[0]
                 continue
-            ifd['tags'][key] = record
-        if geotag:
-            if 'geotag' not in ifd:
-                ifd['geotag'] = [[1, 1, 1, 0], [], '']
-            try:
-                taginfo = tifftools.constants.GeoTiffGeoKey[geotag.groups()[0]]
-            except Exception:
-                isgeo = None
-                ifd.pop('geotag', None)
+            if line.startswith('Header: '):
+                info = {}
+                files.append((info, currentName))
+                currentName = None
+                info['bigEndian'] = 'big-endian' in line
+                info['bigtiff'] = 'BigTIFF' in line
+                ifd = None
+                info['ifds'] = []
+                ifdlist = []
                 continue
-            key = taginfo.value
-            if taginfo['datatype'] == tifftools.Datatype.DOUBLE:
-                ttype = tifftools.Tag.GeoDoubleParamsTag.value
-                val = [float(v) for v in geotag.groups()[1].split()]
-                if (len(val) == 1 and int(val[0]) == val[0] and
-                        val[0] >= -32768 and val[0] <= 32767):
-                    ttype, count, offset = 0, 1, int(val[0])
+            tag = TTDUMP_TAG.match(line) if ' (0x' in line else None
+            tdir = subifd = geotag = None
+            if not tag:
+                tdir = TTDUMP_DIRECTORY.match(line) if 'Directory ' in line else None
+                if not tdir and ':' in line:
+                    subifd = TTDUMP_SUBIFD.match(line)
+                    if not subifd and isgeo:
+                        geotag = TTDUMP_GEOTAG.match(line)
+                if not tdir and not subifd and not geotag:
+                    if lastascii:
+                        lastascii['data'] += '\n' + line
+                    continue
+            lastascii = None
+            depth = len(ifdlist)
+            while depth and not line.startswith('  ' * depth):
+                depth -= 1
+            del ifdlist[depth:]
+            if tdir:
+                if not len(ifdlist):
+                    info['ifds'].append({'tags': {}})
+                    ifd = info['ifds'][-1]
                 else:
-                    count = len(val)
-                    offset = len(ifd['geotag'][1])
-                    ifd['geotag'][1].extend(val)
-            elif taginfo['datatype'] == tifftools.Datatype.ASCII:
-                ttype = tifftools.Tag.GeoASCIIParamsTag.value
-                val = geotag.groups()[1] + '|'
-                count = len(val)
-                offset = len(ifd['geotag'][2])
-                ifd['geotag'][2] += val
-            else:
-                ttype = 0
-                count = 1
-                offset = int(geotag.groups()[1])
-            ifd['geotag'][0].extend([key, ttype, count, offset])
-            ifd['geotag'][0][3] += 1
-            ifd['tags'][tifftools.Tag.GeoKeyDirectoryTag.value] = {
-                'datatype': tifftools.Datatype.SHORT,
-                'count': len(ifd['geotag'][0]),
-                'data': ifd['geotag'][0]
-            }
-            if len(ifd['geotag'][1]):
-                ifd['tags'][tifftools.Tag.GeoDoubleParamsTag.value] = {
-                    'datatype': tifftools.Datatype.DOUBLE,
-                    'count': len(ifd['geotag'][1]),
-                    'data': ifd['geotag'][1]
-                }
-            if len(ifd['geotag'][2]):
-                ifd['tags'][tifftools.Tag.GeoASCIIParamsTag.value] = {
-                    'datatype': tifftools.Datatype.ASCII,
-                    'data': ifd['geotag'][2]
-                }
-    return info, currentName
+                    ifdlist[-1].append({'tags': {}})
+                    ifd = ifdlist[-1][-1]
+                ifdlist.append(ifd)
+                continue
+            if subifd:
+                newifd = []
+                key = tifftools.Tag[subifd.group(1)].value
+                ifd['tags'].setdefault(key, {'ifds': []})['ifds'].append(newifd)
+                ifd = None
+                ifdlist.append(newifd)
+                continue
+            if tag:
+                key, record = parse_tag(*tag.groups())
+                if record['datatype'] == tifftools.Datatype.ASCII.value:
+                    lastascii = record
+                isgeo = key == geoDirectoryTag
+                if 'geotag' in ifd and key in geoParamTags:
+                    continue
+                ifd['tags'][key] = record
+                continue
+            if not add_geotag(ifd, *geotag.groups()):
+                isgeo = None
+    return files
 
 
-def main(sourceName, destName, compression):
-    currentName = None
-    try:
-        info = json.load(open(sourceName, 'r'))
-    except Exception:
-        try:
-            info = pickle.load(open(sourceName, 'rb'))
-        except Exception:
-            info, currentName = parse_ttdump(sourceName, destName, compression)
-    if len(info):
-        write(info, currentName, destName, compression)
-        generate_imagej_if_needed(info, destName, compression)
+BINARY_DUMP_MAGIC = b'TTDUMP\x00\x01'
+# Tag data of these tiff datatypes with at least BINARY_DUMP_MIN_ARRAY values
+# is stored as typed arrays in binary dumps.
+BINARY_DUMP_DTYPES = {
+    tifftools.Datatype.BYTE.value: '<u1',
+    tifftools.Datatype.SHORT.value: '<u2',
+    tifftools.Datatype.LONG.value: '<u4',
+    tifftools.Datatype.RATIONAL.value: '<u4',
+    tifftools.Datatype.SBYTE.value: '<i1',
+    tifftools.Datatype.SSHORT.value: '<i2',
+    tifftools.Datatype.SLONG.value: '<i4',
+    tifftools.Datatype.SRATIONAL.value: '<i4',
+    tifftools.Datatype.FLOAT.value: '<f4',
+    tifftools.Datatype.DOUBLE.value: '<f8',
+    tifftools.Datatype.IFD.value: '<u4',
+    tifftools.Datatype.LONG8.value: '<u8',
+    tifftools.Datatype.SLONG8.value: '<i8',
+    tifftools.Datatype.IFD8.value: '<u8',
+}
+BINARY_DUMP_MIN_ARRAY = 16
+
+
+def pack_ifds(ifds, arrays):
+    """
+    Convert a list of ifds to a form that can be stored as JSON, moving large
+    tag data to a list of arrays.
+
+    :param ifds: a list of ifds.
+    :param arrays: a list of numpy arrays to append to.
+    :returns: the converted list of ifds.
+    """
+    import numpy as np
+
+    packed = []
+    for ifd in ifds:
+        ifd = ifd.copy()
+        tags = {}
+        for key, record in ifd['tags'].items():
+            record = record.copy()
+            if 'ifds' in record:
+                record['ifds'] = [pack_ifds(subifds, arrays) for subifds in record['ifds']]
+            data = record.get('data')
+            if isinstance(data, bytes):
+                record['data'] = {'array': len(arrays), 'bytes': True}
+                arrays.append(np.frombuffer(data, np.uint8))
+            elif (data is not None and not isinstance(data, str) and
+                    len(data) >= BINARY_DUMP_MIN_ARRAY and
+                    record['datatype'] in BINARY_DUMP_DTYPES):
+                record['data'] = {'array': len(arrays)}
+                arrays.append(np.asarray(data, BINARY_DUMP_DTYPES[record['datatype']]))
+            tags[str(key)] = record
+        ifd['tags'] = tags
+        packed.append(ifd)
+    return packed
+
+
+def unpack_ifds(ifds, arrays):
+    """
+    Reverse pack_ifds.
+
+    :param ifds: a list of packed ifds.
+    :param arrays: the list of numpy arrays referenced by the packed ifds.
+    :returns: the list of ifds.
+    """
+    for ifd in ifds:
+        tags = {}
+        for key, record in ifd['tags'].items():
+            if 'ifds' in record:
+                record['ifds'] = [unpack_ifds(subifds, arrays) for subifds in record['ifds']]
+            if isinstance(record.get('data'), dict):
+                data = arrays[record['data']['array']]
+                record['data'] = data.tobytes() if record['data'].get('bytes') else data
+            tags[int(key)] = record
+        ifd['tags'] = tags
+    return ifds
+
+
+def write_binary_dump(files, path):
+    """
+    Write parsed dumps to a compact binary file.  This is the magic bytes, the
+    length of a JSON header, the header, and then the data of large tag
+    arrays, each aligned to 8 bytes.
+
+    :param files: a list of tuples of the parsed info and the file name.
+    :param path: the output path.
+    """
+    arrays = []
+    header = {'files': [
+        [dict(info, ifds=pack_ifds(info['ifds'], arrays)) if len(info) else info, name]
+        for info, name in files]}
+    header['arrays'] = []
+    offset = 0
+    for arr in arrays:
+        header['arrays'].append([arr.dtype.str, len(arr), offset])
+        offset += (arr.nbytes + 7) // 8 * 8
+    headerData = json.dumps(header, separators=(',', ':')).encode()
+    with open(path, 'wb') as fptr:
+        fptr.write(BINARY_DUMP_MAGIC)
+        fptr.write(struct.pack('<Q', len(headerData)))
+        fptr.write(headerData + b'\x00' * (-len(headerData) % 8))
+        for arr in arrays:
+            fptr.write(arr.tobytes() + b'\x00' * (-arr.nbytes % 8))
+
+
+def read_binary_dump(path):
+    """
+    Read a binary dump written by write_binary_dump.  Large tag arrays are
+    numpy arrays referencing the file's data rather than lists.
+
+    :param path: the path of the binary dump.
+    :returns: a list of tuples of the parsed info and the file name.
+    """
+    import numpy as np
+
+    with open(path, 'rb') as fptr:
+        data = fptr.read()
+    start = len(BINARY_DUMP_MAGIC) + 8
+    headerLen = struct.unpack('<Q', data[len(BINARY_DUMP_MAGIC):start])[0]
+    header = json.loads(data[start:start + headerLen])
+    base = start + (headerLen + 7) // 8 * 8
+    arrays = [np.frombuffer(data, dtype, count, base + offset)
+              for dtype, count, offset in header['arrays']]
+    return [(dict(info, ifds=unpack_ifds(info['ifds'], arrays)) if len(info) else info, name)
+            for info, name in header['files']]
+
+
+def read_dump(sourceName):
+    """
+    Read a dump, detecting whether it is a binary dump, a pickle or JSON file
+    of tifftools info, or tifftools dump text from the start of the file.
+
+    :param sourceName: the path of the dump.
+    :returns: a list of tuples of the parsed info and the file name or None.
+    """
+    with open(sourceName, 'rb') as fptr:
+        magic = fptr.read(len(BINARY_DUMP_MAGIC))
+    if magic == BINARY_DUMP_MAGIC:
+        return read_binary_dump(sourceName)
+    if magic[:1] == b'\x80':
+        with open(sourceName, 'rb') as fptr:
+            return [(pickle.load(fptr), None)]
+    if magic.lstrip()[:1] == b'{':
+        with open(sourceName) as fptr:
+            return [(json.load(fptr), None)]
+    return parse_ttdump(sourceName)
+
+
+def write_file(info, name, destName, compression, sparse=False):
+    write(info, name, destName, compression, sparse)
+    generate_imagej_if_needed(info, destName, compression, sparse)
+
+
+def output_names(names, destName):
+    """
+    Get the output path for each file in a dump.  A single file is written to
+    the destination.  Multiple files are written to the destination as a
+    directory using the file names listed in the dump.
+
+    :param names: a list of the names listed in the dump; entries may be None.
+    :param destName: the output path.
+    :returns: a list of output paths.
+    """
+    if len(names) == 1:
+        return [destName]
+    os.makedirs(destName, exist_ok=True)
+    destNames = []
+    used = set()
+    for idx, name in enumerate(names):
+        base = os.path.basename(name) if name else '%d.tiff' % idx
+        if base in used:
+            root, ext = os.path.splitext(base)
+            base = '%s-%d%s' % (root, idx, ext)
+        used.add(base)
+        destNames.append(os.path.join(destName, base))
+    return destNames
+
+
+def main(sourceName, destName, compression, sparse=False, workers=None, saveDump=None):
+    files = read_dump(sourceName)
+    files = [(info, name) for info, name in files if len(info)]
+    if saveDump:
+        write_binary_dump(files, saveDump)
+    if not len(files):
+        return
+    destNames = output_names([name for _, name in files], destName)
+    if len(files) == 1 or workers == 1:
+        for (info, name), dest in zip(files, destNames):
+            write_file(info, name, dest, compression, sparse)
+        return
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(write_file, info, name, dest, compression, sparse)
+            for (info, name), dest in zip(files, destNames)]
+        for future in futures:
+            future.result()
 
 
 def command():
@@ -392,14 +1055,38 @@ def command():
         'minimal size, run "tifftools -y <path> --dedup" after this program.  '
         'For a genuine COG, run "gdalwarp -of COG -CO COMPRESS=LZW -CO '
         'BLOCKSIZE=1024 <src path> <desc path>"')
-    parser.add_argument('source', type=str, help='Source tifftools dump filename')
-    parser.add_argument('out', type=str, help='Output image filename')
+    parser.add_argument(
+        'source', type=str,
+        help='Source tifftools dump filename.  This may also be a binary dump '
+        'saved with --save-dump, or a JSON or pickle file of tifftools info.')
+    parser.add_argument(
+        'out', type=str,
+        help='Output image filename.  If the dump contains multiple files, '
+        'this is a directory and the files are written to it using the names '
+        'listed in the dump.')
     parser.add_argument(
         '--compression', default='packbits',
-        help='One of "packbits", "none" to use for the output.  If trying to '
-        'recreate an ImageJ file, use "none".')
+        help='One of "packbits", "none", or "original" to use for the output.  '
+        'If trying to recreate an ImageJ file, use "none".  "original" encodes '
+        'synthetic image content with the compression and photometric '
+        'interpretation listed in the dump, reusing a small pool of tiles, so '
+        'decoding costs resemble the source file.  This requires imagecodecs.')
+    parser.add_argument(
+        '--sparse', action='store_true',
+        help='Fill all image data with zeros and write it as holes in a sparse '
+        'output file.  With "none" compression, very large images take almost '
+        'no time or disk space.')
+    parser.add_argument(
+        '--workers', '-j', type=int,
+        help='The number of processes used to write files when the dump '
+        'contains multiple files.  Default is the number of CPUs.')
+    parser.add_argument(
+        '--save-dump',
+        help='Also save the parsed dump to this path in a compact binary '
+        'format that can be used as the source and is much faster to load.')
     opts = parser.parse_args()
-    main(opts.source, opts.out, opts.compression)
+    main(opts.source, opts.out, opts.compression, opts.sparse, opts.workers,
+         opts.save_dump)
 
 
 if __name__ == '__main__':